@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Run each script against mock-ci-server.py and report throughput, memory and wall time."""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ORG = 'mock-org'
+
+# Script name -> extra command line arguments
+SCRIPTS = {
+    'get-github-artifacts.py': [],
+    'get-github-repo-permissions.py': [],
+    'get-github-single-repo-permissions.py': [f'{ORG}/repo-0000', 'mock-token'],
+    'get-github-workflow-PRs.py': [],
+    'get-circleci-artifacts.py': [],
+    'get-circleci-jobs-env.py': ['-u', 'mock-user', '-p', 'mock-password'],
+}
+
+def get_stats(base_url):
+    with urllib.request.urlopen(f"{base_url}/_stats") as response:
+        return json.load(response)
+
+def run_script(script, args, base_url, work_dir):
+    """Run one script to completion and return its wall time, peak RSS in KB and exit status."""
+    env = dict(
+        os.environ,
+        GITHUB_API_URL=f"{base_url}/github",
+        CIRCLECI_URL=f"{base_url}/circleci",
+        GITHUB_ORG=ORG,
+        GITHUB_TOKEN='mock-token',
+        CIRCLECI_TOKEN='mock-token',
+    )
+    start_time = time.monotonic()
+    with open(os.path.join(work_dir, 'output.log'), 'wb') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, script)] + args, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return time.monotonic() - start_time, usage.ru_maxrss, process.returncode
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scripts in this repository against a local mock GitHub/CircleCI server')
+    parser.add_argument('--repos', type=int, default=50, help='Repositories in the mock organization (default: 50)')
+    parser.add_argument('--artifacts', type=int, default=5, help='Artifacts per repository and per CircleCI job (default: 5)')
+    parser.add_argument('--artifact-kb', type=int, default=64, help='Size of each artifact payload in KB (default: 64)')
+    parser.add_argument('--pipelines', type=int, default=5, help='CircleCI pipelines per project (default: 5)')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Delay added to every mock response (default: 20)')
+    parser.add_argument('--runs', type=int, default=1, help='Runs per script in the same working directory, to measure warm caches (default: 1)')
+    parser.add_argument('scripts', nargs='*', help='Scripts to run (default: all)')
+    args = parser.parse_args()
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPT_DIR, 'mock-ci-server.py'), '--port', '0', '--org', ORG,
+         '--repos', str(args.repos), '--artifacts', str(args.artifacts), '--artifact-kb', str(args.artifact_kb),
+         '--pipelines', str(args.pipelines), '--latency-ms', str(args.latency_ms)],
+        stdout=subprocess.PIPE, text=True
+    )
+    try:
+        base_url = server.stdout.readline().split()[-1]
+        print(f"{'Script':<40} {'Run':>3} {'Wall s':>8} {'Requests':>9} {'Req/s':>8} {'MB':>8} {'MB/s':>7} {'Peak RSS MB':>12} {'Exit':>5}")
+        for script in args.scripts or SCRIPTS:
+            with tempfile.TemporaryDirectory() as work_dir:
+                for run in range(1, args.runs + 1):
+                    before = get_stats(base_url)
+                    wall_time, peak_rss, exit_code = run_script(script, SCRIPTS.get(script, []), base_url, work_dir)
+                    after = get_stats(base_url)
+                    requests_made = after['requests'] - before['requests']
+                    megabytes = (after['bytes_sent'] - before['bytes_sent']) / (1024 * 1024)
+                    print(
+                        f"{script:<40} {run:>3} {wall_time:>8.2f} {requests_made:>9} {requests_made / wall_time:>8.1f} "
+                        f"{megabytes:>8.2f} {megabytes / wall_time:>7.2f} {peak_rss / 1024:>12.1f} {exit_code:>5}"
+                    )
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1887 @@
+#!/usr/bin/env python3
+"""Shared HTTP helpers for the GitHub and CircleCI scripts in this repository."""
+import atexit
+import hashlib
+import json
+import os
+import queue
+import re
+import shutil
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import get_encoding_from_headers, select_proxy
+
+try:
+    import httpx
+    import h2  # noqa: F401 - httpx needs it for HTTP/2
+except ImportError:
+    httpx = None
+
+# Configuration
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')  # Override to target GitHub Enterprise or a local stand-in
+RATE_LIMIT_BURST = int(os.getenv('CI_RATE_LIMIT_BURST', '100'))  # Requests allowed back-to-back before pacing kicks in
+MAX_RETRIES = int(os.getenv('CI_MAX_RETRIES', '5'))  # Retries after a rate-limited response
+SECONDARY_BACKOFF = 60  # Initial wait in seconds for a secondary rate limit without Retry-After
+CIRCLECI_UNFINISHED_STATUSES = ('running', 'failing', 'on_hold')  # Workflow statuses that may still produce jobs
+MAX_CONNECTIONS_PER_HOST = int(os.getenv('CI_MAX_CONNECTIONS_PER_HOST', '16'))  # Requests beyond this wait for a free connection
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('CI_DOWNLOAD_CHUNK_SIZE', str(1024 * 1024)))  # Bytes read and written per chunk when downloading
+DOWNLOAD_RETRIES = int(os.getenv('CI_DOWNLOAD_RETRIES', '3'))  # Resume attempts after a dropped connection
+MAX_BANDWIDTH = os.getenv('CI_MAX_BANDWIDTH')  # Combined download rate cap in bytes per second, e.g. '20M'
+METRICS_FILE = os.getenv('CI_METRICS_FILE')  # Periodic export, Prometheus textfile format for *.prom and NDJSON otherwise
+METRICS_INTERVAL = float(os.getenv('CI_METRICS_INTERVAL', '60'))  # Seconds between exports to METRICS_FILE
+METRICS_SUMMARY = os.getenv('CI_METRICS_SUMMARY', '1') != '0'  # Print a per-endpoint summary to stderr at exit
+HTTP_CACHE_FILE = os.getenv('CI_HTTP_CACHE', 'http_cache.sqlite')  # Set to an empty string to disable the response cache
+HTTP_CACHE_MAX_MB = int(os.getenv('CI_HTTP_CACHE_MAX_MB', '256'))  # Least recently used entries are evicted beyond this size
+HTTP2 = os.getenv('CI_HTTP2', '0') == '1'  # Set to 1 to multiplex API calls over HTTP/2 when httpx and h2 are installed
+GITHUB_TOKENS = os.getenv('GITHUB_TOKENS', '')  # Extra comma-separated GitHub tokens that per-repository calls are spread across
+GITHUB_TOKENS_FILE = os.getenv('GITHUB_TOKENS_FILE')  # File with one more GitHub token per line, '#' starts a comment
+SHARD = os.getenv('CI_SHARD')  # 'i/N' to process only the repositories that hash to shard i of N (0 <= i < N)
+SHARD_LEASES = os.getenv('CI_SHARD_LEASES')  # SQLite file (or directory) through which workers hand out repositories one at a time
+INVENTORY_FILE = os.getenv('CI_INVENTORY_FILE', 'repo_inventory.sqlite')  # Organization repository lists shared by every script, empty to disable
+INVENTORY_TTL = int(os.getenv('CI_INVENTORY_TTL', '3600'))  # Seconds a cached repository list is reused before the organization is listed again
+LEASE_TIMEOUT = int(os.getenv('CI_LEASE_TIMEOUT', '600'))  # Seconds without a heartbeat after which a worker's repositories are handed out again
+RESULTS_FILE = os.getenv('CI_RESULTS_FILE')  # Append structured results to this SQLite (*.sqlite, *.db) or NDJSON file, see diff-results.py
+RESULTS_RUN = os.getenv('CI_RESULTS_RUN')  # Run ID stamped on the results, e.g. shared by the workers of one sharded scan (default: start time)
+
+
+class RateLimiter:
+    """Token bucket paced by the X-RateLimit-* headers returned by one host.
+
+    The refill rate is recalculated from every response so that the remaining
+    budget is spread evenly over the time left until the limit resets.
+    """
+
+    def __init__(self, burst=RATE_LIMIT_BURST):
+        self.lock = threading.Lock()
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.rate = None  # Tokens per second, unknown until the first response
+        self.remaining = None
+        self.reset = None
+        self.last_refill = time.monotonic()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        with self.lock:
+            now = time.monotonic()
+            if self.rate:
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            delay = 0.0
+            if self.remaining == 0 and self.reset:
+                # Budget exhausted, nothing will be accepted until the window resets
+                delay = max(0.0, self.reset - time.time()) + 1
+            elif self.tokens < 1 and self.rate:
+                delay = (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        if delay:
+            metrics.add_time('rate_limit_wait', delay)
+            time.sleep(delay)
+
+    def update(self, response):
+        """Recalculate the refill rate from the rate limit headers of a response."""
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            self.remaining = int(remaining)
+            self.reset = int(reset)
+            window = max(self.reset - time.time(), 1)
+            self.rate = self.remaining / window
+            self.tokens = min(self.tokens, self.remaining)
+
+    @staticmethod
+    def backoff_delay(response, attempt):
+        """Return how long to wait before retrying a rate-limited response, or None if it was not rate limited."""
+        if response.status_code not in (403, 429):
+            return None
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            return float(retry_after)
+        if response.headers.get('X-RateLimit-Remaining') == '0' and response.headers.get('X-RateLimit-Reset'):
+            return max(0.0, int(response.headers['X-RateLimit-Reset']) - time.time()) + 1
+        if response.status_code == 429 or 'secondary rate limit' in response.text.lower():
+            return SECONDARY_BACKOFF * 2 ** attempt
+        return None  # A plain 403 is a permissions problem, not a rate limit
+
+
+# Path segments that vary per repository or object, collapsed so that metrics are grouped per endpoint
+ENDPOINT_PATTERNS = (
+    (re.compile(r'/repos/[^/]+/[^/]+'), '/repos/{owner}/{repo}'),
+    (re.compile(r'/orgs/[^/]+'), '/orgs/{org}'),
+    (re.compile(r'/project/gh/[^/]+/[^/]+'), '/project/gh/{org}/{repo}'),
+    (re.compile(r'/raw/github/[^/]+/[^/]+'), '/raw/github/{org}/{repo}'),
+    (re.compile(r'/(pipeline|workflow)/[^/]+(?=/)'), r'/\1/{id}'),
+    (re.compile(r'/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(?=/|$)'), '/{id}'),
+    (re.compile(r'/[0-9a-f]{20,}(?=/|$)'), '/{sha}'),
+    (re.compile(r'/\d+(?=/|$)'), '/{n}'),
+)
+
+
+def endpoint_template(url):
+    """Return the host and path of a URL with IDs and names replaced by placeholders."""
+    parsed = urlparse(url)
+    path = parsed.path
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return f"{parsed.netloc}{path}"
+
+
+class Metrics:
+    """Request statistics per endpoint template, plus time spent waiting, retrying and writing to disk."""
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = {}
+        self.timers = {}
+        self.counters = {}
+        self.rate_limits = {}
+
+    def record_request(self, response, elapsed, streamed=False):
+        template = endpoint_template(response.request.url)
+        # A streamed body has not been read yet, so count what the server announced
+        size = int(response.headers.get('Content-Length', 0)) if streamed else len(response.content or b'')
+        with self.lock:
+            endpoint = self.endpoints.setdefault(template, {
+                'count': 0, 'latency_sum': 0.0, 'latency_max': 0.0, 'bytes': 0, 'statuses': {},
+                'buckets': [0] * (len(self.LATENCY_BUCKETS) + 1),
+            })
+            endpoint['count'] += 1
+            endpoint['latency_sum'] += elapsed
+            endpoint['latency_max'] = max(endpoint['latency_max'], elapsed)
+            endpoint['bytes'] += size
+            status = str(response.status_code)
+            endpoint['statuses'][status] = endpoint['statuses'].get(status, 0) + 1
+            bucket = next((i for i, bound in enumerate(self.LATENCY_BUCKETS) if elapsed <= bound), len(self.LATENCY_BUCKETS))
+            endpoint['buckets'][bucket] += 1
+
+            remaining = response.headers.get('X-RateLimit-Remaining')
+            if remaining is not None:
+                host = urlparse(response.request.url).netloc
+                limit = self.rate_limits.setdefault(host, {'min_remaining': int(remaining)})
+                limit['remaining'] = int(remaining)
+                limit['limit'] = int(response.headers.get('X-RateLimit-Limit', 0))
+                limit['min_remaining'] = min(limit['min_remaining'], int(remaining))
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps({
+                'time': time.time(),
+                'elapsed': time.time() - self.started,
+                'endpoints': self.endpoints,
+                'timers': self.timers,
+                'counters': self.counters,
+                'rate_limits': self.rate_limits,
+            }))
+
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = [f"\n{'Endpoint':<70} {'Requests':>8} {'Avg ms':>8} {'Max ms':>8} {'MB':>8}  Statuses"]
+        for template, endpoint in sorted(snapshot['endpoints'].items(), key=lambda item: -item[1]['latency_sum']):
+            statuses = ' '.join(f"{status}:{count}" for status, count in sorted(endpoint['statuses'].items()))
+            lines.append(
+                f"{template[:70]:<70} {endpoint['count']:>8} {endpoint['latency_sum'] / endpoint['count'] * 1000:>8.0f} "
+                f"{endpoint['latency_max'] * 1000:>8.0f} {endpoint['bytes'] / (1024 * 1024):>8.2f}  {statuses}"
+            )
+        for name, seconds in sorted(snapshot['timers'].items()):
+            lines.append(f"{name}: {seconds:.1f}s")
+        for name, count in sorted(snapshot['counters'].items()):
+            lines.append(f"{name}: {count}")
+        for host, limit in sorted(snapshot['rate_limits'].items()):
+            lines.append(f"Rate limit {host}: {limit['remaining']}/{limit['limit']} remaining, lowest {limit['min_remaining']}")
+        lines.append(f"Wall time: {snapshot['elapsed']:.1f}s")
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        for template, endpoint in sorted(snapshot['endpoints'].items()):
+            label = template.replace('\\', '\\\\').replace('"', '\\"')
+            cumulative = 0
+            for bound, count in zip(self.LATENCY_BUCKETS + ('+Inf',), endpoint['buckets']):
+                cumulative += count
+                lines.append(f'ci_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'ci_request_duration_seconds_sum{{endpoint="{label}"}} {endpoint["latency_sum"]}')
+            lines.append(f'ci_request_duration_seconds_count{{endpoint="{label}"}} {endpoint["count"]}')
+            lines.append(f'ci_response_bytes_total{{endpoint="{label}"}} {endpoint["bytes"]}')
+            for status, count in sorted(endpoint['statuses'].items()):
+                lines.append(f'ci_responses_total{{endpoint="{label}",status="{status}"}} {count}')
+        for name, seconds in sorted(snapshot['timers'].items()):
+            lines.append(f'ci_{name}_seconds_total {seconds}')
+        for name, count in sorted(snapshot['counters'].items()):
+            lines.append(f'ci_{name}_total {count}')
+        for host, limit in sorted(snapshot['rate_limits'].items()):
+            lines.append(f'ci_rate_limit_remaining{{host="{host}"}} {limit["remaining"]}')
+            lines.append(f'ci_rate_limit_limit{{host="{host}"}} {limit["limit"]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """Write the metrics to a Prometheus textfile (*.prom, replaced atomically) or append an NDJSON snapshot."""
+        if path.endswith('.prom'):
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w') as file:
+                file.write(self.prometheus())
+            os.replace(temp_path, path)
+        else:
+            with open(path, 'a') as file:
+                file.write(json.dumps(self.snapshot()) + '\n')
+
+
+metrics = Metrics()
+
+
+def export_metrics_periodically():
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        metrics.export(METRICS_FILE)
+
+
+def report_metrics():
+    if METRICS_FILE:
+        metrics.export(METRICS_FILE)
+    if METRICS_SUMMARY and metrics.endpoints:
+        print(metrics.summary(), file=sys.stderr)
+
+
+atexit.register(report_metrics)
+if METRICS_FILE:
+    threading.Thread(target=export_metrics_periodically, daemon=True).start()
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def rate_limit_resource(url):
+    """Return the GitHub rate limit bucket a request is expected to count against, as in X-RateLimit-Resource."""
+    path = urlparse(url).path
+    if path.endswith('/graphql'):
+        return 'graphql'
+    if '/search/' in path:
+        return 'search'
+    return 'core'
+
+
+def get_limiter(url, token=None, resource=None):
+    """Return the RateLimiter shared by every request to the host of the given URL with the same token and rate limit resource.
+
+    GitHub keeps separate budgets per resource (core, graphql, search), so
+    one running out must not hold back requests that count against another.
+    """
+    key = (urlparse(url).netloc, token, resource or rate_limit_resource(url))
+    with limiters_lock:
+        if key not in limiters:
+            limiters[key] = RateLimiter()
+        return limiters[key]
+
+
+def load_github_tokens():
+    """Return GITHUB_TOKEN followed by the tokens from GITHUB_TOKENS and GITHUB_TOKENS_FILE, without duplicates."""
+    tokens = [os.getenv('GITHUB_TOKEN')] + GITHUB_TOKENS.split(',')
+    if GITHUB_TOKENS_FILE:
+        with open(GITHUB_TOKENS_FILE) as f:
+            tokens += [line.split('#', 1)[0] for line in f]
+    return list(dict.fromkeys(token.strip() for token in tokens if token and token.strip()))
+
+
+def request_token(request):
+    """Return the token from the Authorization header of a request, or None."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token or None
+
+
+def set_request_token(request, token):
+    scheme = request.headers['Authorization'].partition(' ')[0]
+    request.headers['Authorization'] = f"{scheme} {token}"
+
+
+def token_scope(request):
+    """Return 'owner/repo' for a GitHub API request about a single repository, or None.
+
+    Only these requests are spread across the token pool. Listings such as
+    /orgs/{org}/repos depend on what the calling token can see, so they keep
+    the token they were made with.
+    """
+    if not request.url.startswith(GITHUB_API_URL):
+        return None
+    path = urlparse(request.url).path[len(urlparse(GITHUB_API_URL).path):]
+    match = re.match(r'/repos/([^/]+)/([^/]+)', path)
+    if match:
+        return f"{match[1]}/{match[2]}".lower()
+    if path == '/graphql' and request.body:
+        variables = json.loads(request.body).get('variables') or {}
+        if variables.get('owner') and variables.get('name'):
+            return f"{variables['owner']}/{variables['name']}".lower()
+    return None
+
+
+class TokenPool:
+    """GitHub tokens that per-repository requests are spread across, most remaining quota first.
+
+    Tokens can differ in which repositories they reach. A token refused by
+    is_denied() for a repository is not used for that repository again and
+    the request is retried with the next token, so one token's narrower scope
+    does not show up as missing results. A token that has a cached response
+    for a URL is tried first while it has quota, so the cache can revalidate.
+    """
+
+    def __init__(self, tokens):
+        self.lock = threading.Lock()
+        self.tokens = tokens
+        self.quota = {}  # (token, resource) -> (remaining, reset)
+        self.denied = set()  # (token, scope)
+
+    def __contains__(self, token):
+        return token in self.tokens
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def candidates(self, scope, resource):
+        """Return the tokens not yet refused for scope, the one with the most remaining quota first."""
+        now = time.time()
+
+        def headroom(token):
+            remaining, reset = self.quota.get((token, resource), (None, None))
+            if remaining is None or reset <= now:
+                return float('inf')  # Unused so far, or the window has reset since
+            return remaining
+
+        with self.lock:
+            return sorted((token for token in self.tokens if (token, scope) not in self.denied), key=headroom, reverse=True)
+
+    def has_quota(self, token, resource):
+        with self.lock:
+            remaining, reset = self.quota.get((token, resource), (None, None))
+        return remaining is None or remaining > 0 or reset <= time.time()
+
+    def update(self, token, response):
+        """Record the remaining quota of a token from the rate limit headers of a response."""
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        resource = response.headers.get('X-RateLimit-Resource', 'core')
+        with self.lock:
+            self.quota[(token, resource)] = (int(remaining), int(reset))
+
+    def deny(self, token, scope):
+        with self.lock:
+            self.denied.add((token, scope))
+
+
+token_pool = TokenPool(load_github_tokens())
+GITHUB_TOKEN = token_pool.tokens[0] if token_pool.tokens else None  # GITHUB_TOKEN, or the first token of the pool when it is unset
+
+
+def is_exhausted(response):
+    """Return True if a response was refused because its token has no quota left until the limit resets."""
+    return response.status_code in (403, 429) and response.headers.get('X-RateLimit-Remaining') == '0'
+
+
+def is_denied(response):
+    """Return True if a response means the token has no access to the requested repository.
+
+    A 404 only counts for the repository itself, since a missing resource
+    inside a repository the token can see is a genuine answer.
+    RateLimitedSession.send() still tries the other tokens on a sub-resource
+    404, without denying the token.
+    """
+    if response.status_code == 401:
+        return True
+    if response.status_code == 404:
+        path = urlparse(response.request.url).path[len(urlparse(GITHUB_API_URL).path):]
+        return re.fullmatch(r'/repos/[^/]+/[^/]+/?', path) is not None
+    if response.status_code == 403:
+        return RateLimiter.backoff_delay(response, 0) is None
+    if response.status_code == 200 and response.request.url.endswith('/graphql'):
+        errors = response.json().get('errors') or []
+        return any(
+            error.get('type') in ('NOT_FOUND', 'FORBIDDEN') and (error.get('path') or ['repository'])[0] == 'repository'
+            for error in errors
+        )
+    return False
+
+
+class ResponseCache:
+    """SQLite-backed cache of GET responses, revalidated with ETag/Last-Modified.
+
+    Entries are keyed by URL and Authorization header so that results seen by
+    one token are never served to another. GitHub does not count 304 responses
+    against the rate limit, so revalidating an unchanged page is free. Hits
+    write their last use in batches, and the total size is kept as a running
+    count, so neither a hit nor a store scans or commits more than it needs.
+    """
+
+    def __init__(self, path, max_bytes, batch_size=100):
+        self.lock = threading.Lock()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.connection = None
+        self.total_bytes = 0  # Running size of all bodies, summed once when the file is opened
+        self.touched = {}  # key -> last use not yet written
+        atexit.register(self.close)
+
+    @property
+    def db(self):
+        """The SQLite connection, opened on first use so that importing ci_common creates no file. Call with the lock held."""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT, body BLOB, size INTEGER, last_used REAL)'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+            self.connection.commit()
+            self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self.connection
+
+    @staticmethod
+    def key(request, authorization=None):
+        """Return the cache key of a request, or of the same request sent with another Authorization header."""
+        auth = request.headers.get('Authorization', '') if authorization is None else authorization
+        return hashlib.sha256(f"{request.url}\n{auth}".encode('utf-8')).hexdigest()
+
+    def contains(self, key):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM responses WHERE key = ?', (key,)).fetchone() is not None
+
+    def lookup(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT etag, last_modified, headers, body FROM responses WHERE key = ?', (key,)).fetchone()
+            if row:
+                # Last use only orders eviction, so it is written in batches rather than on every hit
+                self.touched[key] = time.time()
+                if len(self.touched) >= self.batch_size:
+                    self.write_touched()
+                    self.db.commit()
+        return row
+
+    def write_touched(self):
+        if self.touched:
+            self.db.executemany('UPDATE responses SET last_used = ? WHERE key = ?', [(t, key) for key, t in self.touched.items()])
+            self.touched.clear()
+
+    def store(self, key, response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        # The body is stored decoded, so the transfer headers no longer apply to it
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+        body = response.content
+        with self.lock:
+            replaced = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, etag, last_modified, json.dumps(headers), body, len(body), time.time())
+            )
+            self.touched.pop(key, None)
+            self.total_bytes += len(body) - (replaced[0] if replaced else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.db.commit()
+
+    def evict(self):
+        """Delete least recently used entries until the total size fits max_bytes."""
+        self.write_touched()
+        while self.total_bytes > self.max_bytes:
+            rows = self.db.execute('SELECT key, size FROM responses ORDER BY last_used LIMIT ?', (self.batch_size,)).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                return
+            for key, size in rows:
+                self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    return
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.write_touched()
+                self.connection.commit()
+
+
+response_cache = ResponseCache(HTTP_CACHE_FILE, HTTP_CACHE_MAX_MB * 1024 * 1024) if HTTP_CACHE_FILE else None
+
+
+class HTTP2Adapter(HTTPAdapter):
+    """Transport adapter that sends buffered requests through an HTTP/2 httpx client.
+
+    Concurrent API calls to one host are multiplexed over a single connection,
+    with one client per host so MAX_CONNECTIONS_PER_HOST applies to each.
+    Streamed downloads keep using the HTTP/1.1 pool of the base adapter, since
+    their responses are read incrementally through response.raw. So do requests
+    with a custom CA bundle or verify setting (including REQUESTS_CA_BUNDLE),
+    a client certificate or a proxy, which the base adapter already handles.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lock = threading.Lock()
+        self.clients = {}  # scheme://host -> httpx.Client
+
+    def client(self, url):
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        with self.lock:
+            if origin not in self.clients:
+                self.clients[origin] = httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=MAX_CONNECTIONS_PER_HOST, max_keepalive_connections=MAX_CONNECTIONS_PER_HOST),
+                    timeout=None,
+                )
+            return self.clients[origin]
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if stream or verify is not True or cert or select_proxy(request.url, proxies):
+            return super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(None, connect=timeout[0], read=timeout[1])
+        try:
+            result = self.client(request.url).request(request.method, request.url, headers=request.headers, content=request.body, timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e, request=request)
+
+        response = requests.Response()
+        response.status_code = result.status_code
+        response.reason = result.reason_phrase
+        response.headers = requests.structures.CaseInsensitiveDict(result.headers.items())
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        # httpx has already decoded the body, so requests must not read or decode it again
+        response._content = result.content
+        response._content_consumed = True
+        return response
+
+    def close(self):
+        super().close()
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+
+class RateLimitedSession(requests.Session):
+    """requests.Session that paces requests per host, retries rate-limited responses and revalidates cached GETs.
+
+    Per-repository GitHub requests made with a token from token_pool are sent
+    with whichever pool token has the most quota left, unless rotate_tokens is
+    False.
+
+    Connections are kept alive and reused across calls. At most
+    MAX_CONNECTIONS_PER_HOST connections are opened to each host; threads
+    sharing the session wait for a free connection beyond that. Responses are
+    negotiated as gzip and, with CI_HTTP2=1 and httpx installed with HTTP/2
+    support, API calls to HTTPS hosts are multiplexed over HTTP/2.
+    """
+
+    def __init__(self, rotate_tokens=True):
+        super().__init__()
+        self.rotate_tokens = rotate_tokens
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+        adapter = HTTPAdapter(pool_maxsize=MAX_CONNECTIONS_PER_HOST, pool_block=True)
+        if HTTP2 and httpx:
+            self.mount('https://', HTTP2Adapter(pool_maxsize=MAX_CONNECTIONS_PER_HOST, pool_block=True))
+        else:
+            self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def send(self, request, **kwargs):
+        token = request_token(request)
+        scope = token_scope(request) if self.rotate_tokens and len(token_pool) > 1 and token in token_pool else None
+        if not scope:
+            return self.send_cached(request, **kwargs)
+
+        resource = rate_limit_resource(request.url)
+        candidates = token_pool.candidates(scope, resource) or [token]
+        if response_cache and request.method == 'GET' and not kwargs.get('stream'):
+            # The token a cached response was stored under can revalidate it for free
+            auth_scheme = request.headers['Authorization'].partition(' ')[0]
+            cached_token = next((
+                candidate for candidate in candidates
+                if token_pool.has_quota(candidate, resource) and response_cache.contains(response_cache.key(request, f"{auth_scheme} {candidate}"))
+            ), None)
+            if cached_token:
+                candidates.remove(cached_token)
+                candidates.insert(0, cached_token)
+        response = None
+        for index, candidate in enumerate(candidates):
+            if response is not None:
+                response.close()
+            request.headers.pop('If-None-Match', None)
+            request.headers.pop('If-Modified-Since', None)
+            set_request_token(request, candidate)
+            # Every token but the last moves on to the next one instead of waiting for its quota to reset
+            switch_when_exhausted = index < len(candidates) - 1
+            response = self.send_cached(request, switch_when_exhausted=switch_when_exhausted, **kwargs)
+            if switch_when_exhausted and is_exhausted(response):
+                metrics.increment('token_switched')
+                continue
+            if is_denied(response):
+                token_pool.deny(candidate, scope)
+                metrics.increment('token_denied')
+                continue
+            if response.status_code == 404 and index < len(candidates) - 1:
+                # GitHub also answers 404 for sub-resources of a repository the token cannot see, so a 404
+                # is only genuine once every token gives it. The token is not denied, it may see the repository.
+                metrics.increment('token_not_found')
+                continue
+            return response
+        return response
+
+    def send_cached(self, request, switch_when_exhausted=False, **kwargs):
+        cache_key = None
+        cached = None
+        if response_cache and request.method == 'GET' and not kwargs.get('stream'):
+            cache_key = response_cache.key(request)
+            cached = response_cache.lookup(cache_key)
+            if cached:
+                etag, last_modified = cached[0], cached[1]
+                if etag:
+                    request.headers['If-None-Match'] = etag
+                if last_modified:
+                    request.headers['If-Modified-Since'] = last_modified
+
+        response = self.send_with_backoff(request, switch_when_exhausted, **kwargs)
+
+        if cached and response.status_code == 304:
+            metrics.increment('cache_revalidated')
+            headers = json.loads(cached[2])
+            headers.update(response.headers)
+            response.status_code = 200
+            response.reason = 'OK (cached)'
+            response.headers = requests.structures.CaseInsensitiveDict(headers)
+            response._content = cached[3]
+        elif cache_key and response.status_code == 200:
+            response_cache.store(cache_key, response)
+        return response
+
+    def send_with_backoff(self, request, switch_when_exhausted=False, **kwargs):
+        token = request_token(request)
+        limiter = get_limiter(request.url, token)
+        for attempt in range(MAX_RETRIES + 1):
+            limiter.acquire()
+            start_time = time.monotonic()
+            response = super().send(request, **kwargs)
+            if response.history:
+                # Later hops went through self.send() and were recorded there; record the first under the original URL
+                metrics.record_request(response.history[0], response.history[0].elapsed.total_seconds())
+            else:
+                metrics.record_request(response, time.monotonic() - start_time, kwargs.get('stream'))
+            # The response names the budget it counted against, which is authoritative
+            resource = response.headers.get('X-RateLimit-Resource')
+            if resource:
+                limiter = get_limiter(request.url, token, resource)
+            limiter.update(response)
+            if token in token_pool:
+                token_pool.update(token, response)
+            delay = limiter.backoff_delay(response, attempt)
+            if delay is None or attempt == MAX_RETRIES or (switch_when_exhausted and is_exhausted(response)):
+                return response
+            print(f"Rate limited by {urlparse(request.url).netloc}, retrying in {delay:.0f}s")
+            metrics.increment('retries')
+            metrics.add_time('backoff', delay)
+            response.close()
+            time.sleep(delay)
+        return response
+
+
+default_session = RateLimitedSession()
+# For requests whose result depends on which token makes them, such as permission checks
+pinned_session = RateLimitedSession(rotate_tokens=False)
+
+
+def get(url, **kwargs):
+    """Drop-in replacement for requests.get that goes through the rate limiter."""
+    return default_session.get(url, **kwargs)
+
+
+def paginate_circleci(session, url):
+    """Yield every item from a CircleCI v2 list endpoint, following next_page_token."""
+    page_token = None
+    while True:
+        response = session.get(url, params={'page-token': page_token} if page_token else None)
+        response.raise_for_status()
+        page = response.json()
+        yield from page.get('items', [])
+        page_token = page.get('next_page_token')
+        if not page_token:
+            break
+
+
+def circleci_project_slugs(org_name, token):
+    """Yield the CircleCI project slug ('org/repo') of every repository in a GitHub organization, from the shared inventory."""
+    for repo in get_repo_inventory(org_name, token):
+        yield f"{org_name}/{repo['name']}"
+
+
+# TreeWalker levels shared by the CircleCI scripts: projects -> pipelines -> workflows -> jobs.
+# Bind the session and API URL (and progress store) with functools.partial.
+
+def list_circleci_pipelines(session, api_url, progress_store, path):
+    """Return the project's pipelines newer than the last fully processed one, newest first.
+
+    ``path`` is ``(project_slug,)``. The cut-off is the pipeline watermark that
+    PipelineWatermarks keeps in progress_store.
+    """
+    project_slug, = path
+    last_processed = progress_store.pipeline_watermark(project_slug)
+    pipelines = []
+    for pipeline in paginate_circleci(session, f'{api_url}/project/gh/{project_slug}/pipeline'):
+        if pipeline['number'] <= last_processed:
+            break
+        pipelines.append(pipeline)
+    return pipelines
+
+
+def list_circleci_workflows(session, api_url, path):
+    """Return the workflows of the pipeline at the end of ``path``."""
+    pipeline = path[-1]
+    return list(paginate_circleci(session, f"{api_url}/pipeline/{pipeline['id']}/workflow"))
+
+
+def list_circleci_jobs(session, api_url, path):
+    """Return the jobs of the workflow at the end of ``path`` that have a job number, i.e. have started."""
+    workflow = path[-1]
+    jobs = paginate_circleci(session, f"{api_url}/workflow/{workflow['id']}/job")
+    return [job for job in jobs if 'job_number' in job]
+
+
+class PipelineWatermarks:
+    """Collects the pipeline numbers processed per project during a run and advances the stored watermark.
+
+    A pipeline that had unfinished workflows or failed to process keeps the
+    watermark below it, so the next run visits it again.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.newest = {}
+        self.oldest_incomplete = {}
+
+    def seen(self, project, pipeline_number):
+        self.newest[project] = max(self.newest.get(project, -1), pipeline_number)
+
+    def incomplete(self, project, pipeline_number):
+        self.oldest_incomplete[project] = min(self.oldest_incomplete.get(project, pipeline_number), pipeline_number)
+
+    def commit(self, project):
+        last_processed = self.store.pipeline_watermark(project)
+        newest = self.newest.pop(project, last_processed)
+        oldest_incomplete = self.oldest_incomplete.pop(project, None)
+        if oldest_incomplete is not None:
+            newest = min(newest, oldest_incomplete - 1)
+        if newest > last_processed:
+            self.store.set_pipeline_watermark(project, newest)
+
+
+class TreeWalker:
+    """Expand a tree of API listings with a bounded thread pool per level.
+
+    ``levels[i](path)`` returns the children of the node reached through
+    ``path``, a tuple of the root and its descendants. Children of every level
+    but the last are expanded in turn; a level may return None for a node
+    with nothing to expand. Fetches run in the pools while walk()
+    yields ``(depth, path, result)`` from the calling thread as each one
+    completes, so printing and progress writes stay in a single consumer.
+    ``result`` is the exception raised if a fetch failed, in which case the
+    subtree below it is not expanded. Roots are taken from the iterable as
+    earlier ones finish, a few more than the first level has workers.
+    """
+
+    def __init__(self, levels, workers):
+        self.levels = levels
+        self.workers = workers
+
+    def walk(self, roots, on_root_done=None):
+        """Yield fetch results for every root; on_root_done(root) is called once a root's subtree is finished."""
+        done = queue.Queue()
+        outstanding = {}  # Pending fetches per started root index
+        started = {}  # Root per started root index
+        executors = [ThreadPoolExecutor(max_workers=max(1, w)) for w in self.workers]
+        max_active_roots = 2 * max(1, self.workers[0])
+        roots = enumerate(roots)
+
+        def submit(root_index, depth, path):
+            outstanding[root_index] += 1
+            future = executors[depth].submit(self.levels[depth], path)
+            future.add_done_callback(lambda f: done.put((root_index, depth, path, f)))
+
+        def start_roots():
+            while len(outstanding) < max_active_roots:
+                next_root = next(roots, None)
+                if next_root is None:
+                    return
+                root_index, root = next_root
+                started[root_index] = root
+                outstanding[root_index] = 0
+                submit(root_index, 0, (root,))
+
+        try:
+            start_roots()
+            while outstanding:
+                root_index, depth, path, future = done.get()
+                outstanding[root_index] -= 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                yield depth, path, result
+
+                if not isinstance(result, Exception) and depth + 1 < len(self.levels):
+                    for child in result or ():
+                        submit(root_index, depth + 1, path + (child,))
+                if not outstanding[root_index]:
+                    del outstanding[root_index]
+                    root = started.pop(root_index)
+                    if on_root_done:
+                        on_root_done(root)
+                    start_roots()
+        finally:
+            for executor in executors:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+
+class LeaseTable:
+    """SQLite table through which workers on one or more hosts hand out keys without overlap.
+
+    A worker holds a key until it marks it done. A background heartbeat keeps
+    the worker's leases alive, so the keys of a worker that crashed or was
+    killed become available again LEASE_TIMEOUT seconds after it stopped.
+    Keys are stored under the name of the running script, so different
+    scripts can share one lease file without taking each other's keys.
+    """
+
+    def __init__(self, path, timeout=LEASE_TIMEOUT, script=None):
+        if os.path.isdir(path):
+            path = os.path.join(path, 'leases.sqlite')
+        self.lock = threading.Lock()
+        self.timeout = timeout
+        self.prefix = f"{script or os.path.basename(sys.argv[0])}:"
+        self.worker = f"{socket.gethostname()}-{os.getpid()}"
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, worker TEXT, expires REAL, done INTEGER)')
+        self.db.commit()
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+
+    def claim(self, key):
+        """Lease a key to this worker. Return True if it was leased, False if it is done, None if another worker holds it."""
+        key = self.prefix + key
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT INTO leases VALUES (?, ?, ?, 0) ON CONFLICT (key) DO UPDATE SET worker = excluded.worker, expires = excluded.expires '
+                'WHERE NOT leases.done AND (leases.expires < ? OR leases.worker = excluded.worker)',
+                (key, self.worker, now + self.timeout, now)
+            )
+            self.db.commit()
+            if cursor.rowcount:
+                return True
+            done, = self.db.execute('SELECT done FROM leases WHERE key = ?', (key,)).fetchone()
+        return False if done else None
+
+    def done(self, key):
+        with self.lock:
+            self.db.execute('UPDATE leases SET done = 1 WHERE key = ? AND worker = ?', (self.prefix + key, self.worker))
+            self.db.commit()
+
+    def heartbeat(self):
+        while True:
+            time.sleep(self.timeout / 3)
+            with self.lock:
+                self.db.execute('UPDATE leases SET expires = ? WHERE worker = ? AND NOT done', (time.time() + self.timeout, self.worker))
+                self.db.commit()
+
+
+class Shard:
+    """Selects the repositories this worker processes when one scan is split across processes or hosts.
+
+    With ``spec`` 'i/N' a worker keeps the keys whose stable hash is i modulo
+    N. With ``lease_path`` the keys are handed out through a LeaseTable
+    instead, so workers that finish early take over more of the scan and the
+    keys of a crashed worker are picked up by the workers still running, or
+    by the next one started. Both can be combined.
+    """
+
+    def __init__(self, spec=None, lease_path=None):
+        self.index, self.count = 0, 1
+        if spec:
+            index, _, count = spec.partition('/')
+            self.index, self.count = int(index), int(count)
+            if not 0 <= self.index < self.count:
+                raise ValueError(f"Invalid shard {spec}, expected i/N with 0 <= i < N")
+        self.leases = LeaseTable(lease_path) if lease_path else None
+
+    def owns(self, key):
+        digest = hashlib.sha1(key.lower().encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % self.count == self.index
+
+    def select(self, items, key=lambda item: item):
+        """Yield the items this worker should process, claiming each one when it is reached.
+
+        Items leased to other workers are checked again at the end, and taken
+        over if their leases ran out in the meantime. This never waits, since
+        the caller may only mark its own items done after the last one.
+        """
+        items = (item for item in items if self.owns(key(item)))
+        if not self.leases:
+            yield from items
+            return
+        while True:
+            held_elsewhere = []
+            claimed_any = False
+            for item in items:
+                claimed = self.leases.claim(key(item))
+                if claimed:
+                    claimed_any = True
+                    yield item
+                elif claimed is None:
+                    held_elsewhere.append(item)
+            if not held_elsewhere or not claimed_any:
+                return
+            items = held_elsewhere
+
+    def done(self, key):
+        """Mark a key processed so that no other worker takes it."""
+        if self.leases:
+            self.leases.done(key)
+
+
+def add_shard_arguments(parser):
+    parser.add_argument('--shard', default=SHARD, help='Process only the repositories in shard i of N, given as i/N (default: CI_SHARD)')
+    parser.add_argument('--leases', default=SHARD_LEASES, help='SQLite lease file or directory shared by the workers of one scan (default: CI_SHARD_LEASES)')
+
+
+def graphql(query, variables, token):
+    """Run a GitHub GraphQL query and return its data."""
+    response = default_session.post(f"{GITHUB_API_URL}/graphql", json={'query': query, 'variables': variables}, headers={'Authorization': f'bearer {token}'})
+    response.raise_for_status()
+    result = response.json()
+    if result.get('errors'):
+        raise Exception(f"GraphQL query failed: {result['errors']}")
+    return result['data']
+
+
+REPO_INVENTORY_QUERY = """
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $cursor, orderBy: {field: NAME, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name viewerPermission defaultBranchRef { name } visibility isFork pushedAt }
+    }
+  }
+}
+"""
+
+# REST permission flags, strongest first, mapped to GraphQL viewerPermission values
+REST_PERMISSIONS = (('admin', 'ADMIN'), ('maintain', 'MAINTAIN'), ('push', 'WRITE'), ('triage', 'TRIAGE'), ('pull', 'READ'))
+
+
+def list_org_repositories(org_name, token):
+    """Yield a compact record for every repository in an organization, listed with the given token.
+
+    Uses one GraphQL query per 100 repositories, and the REST listing if
+    GraphQL is unavailable before the first page. See RepoInventory for the
+    record fields.
+    """
+    cursor = None
+    try:
+        while True:
+            repositories = graphql(REPO_INVENTORY_QUERY, {'org': org_name, 'cursor': cursor}, token)['organization']['repositories']
+            for node in repositories['nodes']:
+                yield {
+                    'name': node['name'],
+                    'default_branch': (node['defaultBranchRef'] or {}).get('name', 'master'),
+                    'permission': node['viewerPermission'],
+                    'visibility': node['visibility'],
+                    'fork': node['isFork'],
+                    'pushed_at': node.get('pushedAt'),
+                }
+            if not repositories['pageInfo']['hasNextPage']:
+                return
+            cursor = repositories['pageInfo']['endCursor']
+    except Exception as e:
+        if cursor:
+            raise  # Falling back part way through would list repositories twice
+        print(f"GraphQL inventory unavailable, falling back to REST: {e}")
+
+    url = f"{GITHUB_API_URL}/orgs/{org_name}/repos?per_page=100"
+    while url:
+        response = get(url, headers={'Authorization': f'token {token}', 'Accept': 'application/vnd.github.v3+json'})
+        response.raise_for_status()
+        for repo in response.json():
+            permissions = repo.get('permissions') or {}
+            yield {
+                'name': repo['name'],
+                'default_branch': repo.get('default_branch') or 'master',
+                'permission': next((level for flag, level in REST_PERMISSIONS if permissions.get(flag)), None),
+                'visibility': (repo.get('visibility') or ('private' if repo.get('private') else 'public')).upper(),
+                'fork': repo.get('fork', False),
+                'pushed_at': repo.get('pushed_at'),
+            }
+        url = response.links.get('next', {}).get('url')
+
+
+class RepoInventory:
+    """SQLite cache of the repositories in each organization, as seen by each token.
+
+    Records are dicts with name, default_branch, permission (the token's
+    permission as GraphQL reports it: ADMIN, MAINTAIN, WRITE, TRIAGE, READ
+    or None), visibility (PUBLIC, PRIVATE or INTERNAL), fork and pushed_at.
+    A complete listing younger than INVENTORY_TTL is streamed back from the
+    file, so scripts run one after another list the organization once. An
+    older one is replaced while the organization is listed again, with each
+    repository yielded as soon as its page arrives.
+    """
+
+    FIELDS = ('name', 'default_branch', 'permission', 'visibility', 'fork', 'pushed_at')
+    PAGE_SIZE = 500
+
+    def __init__(self, path, ttl):
+        self.lock = threading.Lock()
+        self.path = path
+        self.ttl = ttl
+        self.connection = None
+
+    @property
+    def db(self):
+        """The SQLite connection, opened on first use so that importing ci_common creates no file. Call with the lock held."""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS listings (org TEXT, viewer TEXT, listed_at REAL, PRIMARY KEY (org, viewer))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS repos (org TEXT, viewer TEXT, name TEXT, default_branch TEXT, permission TEXT, '
+                'visibility TEXT, fork INTEGER, pushed_at TEXT, PRIMARY KEY (org, viewer, name))'
+            )
+            self.connection.commit()
+        return self.connection
+
+    def repositories(self, org_name, token):
+        """Yield the record of every repository in an organization, from the cache while it is fresh."""
+        org_name = org_name.lower()
+        viewer = hashlib.sha256((token or '').encode('utf-8')).hexdigest()  # Permissions and visibility depend on the token
+        with self.lock:
+            row = self.db.execute('SELECT listed_at FROM listings WHERE org = ? AND viewer = ?', (org_name, viewer)).fetchone()
+        if row and time.time() - row[0] < self.ttl:
+            metrics.increment('inventory_cache_hits')
+            yield from self.cached(org_name, viewer)
+            return
+
+        with self.lock:
+            self.db.execute('DELETE FROM listings WHERE org = ? AND viewer = ?', (org_name, viewer))
+            self.db.execute('DELETE FROM repos WHERE org = ? AND viewer = ?', (org_name, viewer))
+            self.db.commit()
+        listed = 0
+        for repo in list_org_repositories(org_name, token):
+            with self.lock:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (org_name, viewer) + tuple(repo[field] for field in self.FIELDS)
+                )
+                listed += 1
+                if listed % 100 == 0:
+                    self.db.commit()
+            yield repo
+        # Only a listing that ran to the end is reused
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?)', (org_name, viewer, time.time()))
+            self.db.commit()
+
+    def cached(self, org_name, viewer):
+        """Yield the cached records in name order, a page of rows at a time."""
+        last_name = ''
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    f"SELECT {', '.join(self.FIELDS)} FROM repos WHERE org = ? AND viewer = ? AND name > ? ORDER BY name LIMIT ?",
+                    (org_name, viewer, last_name, self.PAGE_SIZE)
+                ).fetchall()
+            for row in rows:
+                repo = dict(zip(self.FIELDS, row))
+                repo['fork'] = bool(repo['fork'])
+                yield repo
+            if len(rows) < self.PAGE_SIZE:
+                return
+            last_name = rows[-1][0]
+
+
+inventory = RepoInventory(INVENTORY_FILE, INVENTORY_TTL) if INVENTORY_FILE else None
+
+
+def get_repo_inventory(org_name, token, privacy=None):
+    """Yield the record of every repository in an organization, see RepoInventory.
+
+    ``privacy`` may be 'PUBLIC' or 'PRIVATE' to skip the other repositories.
+    The full listing is cached either way, so it serves every script.
+    """
+    repos = inventory.repositories(org_name, token) if inventory else list_org_repositories(org_name, token)
+    for repo in repos:
+        if privacy == 'PUBLIC' and repo['visibility'] != 'PUBLIC' or privacy == 'PRIVATE' and repo['visibility'] == 'PUBLIC':
+            continue
+        yield repo
+
+
+class ProgressStore:
+    """SQLite store of the jobs processed per (project, scope, workflow).
+
+    ``scope`` is whatever groups workflows in the calling script, e.g. a
+    pipeline ID or a workflow name. Every finished job is recorded on its own,
+    since the jobs of a workflow finish in any order; the highest job number
+    per workflow kept by earlier versions still counts for the jobs up to it.
+    It also keeps the newest pipeline fully
+    processed per CircleCI project and the newest artifact creation time
+    fully processed per GitHub repository. Writes are committed in batches, and
+    SQLite's journal keeps the file consistent if the script is killed.
+    Progress from the old JSON files is imported on first use.
+    """
+
+    def __init__(self, path, legacy_json_path=None, batch_size=100):
+        self.lock = threading.Lock()
+        self.batch_size = batch_size
+        self.pending = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS progress ('
+            'project TEXT, scope TEXT, workflow_id TEXT, job_number INTEGER, PRIMARY KEY (project, scope, workflow_id))'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'project TEXT, scope TEXT, workflow_id TEXT, job_number INTEGER, PRIMARY KEY (project, scope, workflow_id, job_number))'
+        )
+        self.db.execute('CREATE TABLE IF NOT EXISTS watermarks (project TEXT PRIMARY KEY, pipeline_number INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS artifact_watermarks (repo TEXT PRIMARY KEY, created_at TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS legacy_progress (key TEXT PRIMARY KEY, job_number INTEGER)')
+        if legacy_json_path and os.path.exists(legacy_json_path) and not self.db.execute('SELECT 1 FROM legacy_progress LIMIT 1').fetchone():
+            with open(legacy_json_path, 'r') as file:
+                self.db.executemany('INSERT OR REPLACE INTO legacy_progress VALUES (?, ?)', json.load(file).items())
+        self.db.commit()
+        atexit.register(self.close)
+
+    def job_number(self, project, scope, workflow_id):
+        """Return the highest job number recorded for a workflow by earlier versions, or -1."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT job_number FROM progress WHERE project = ? AND scope = ? AND workflow_id = ?', (project, scope, workflow_id)
+            ).fetchone()
+            if not row:
+                row = self.db.execute('SELECT job_number FROM legacy_progress WHERE key = ?', (f"{project}-{scope}-{workflow_id}",)).fetchone()
+        return row[0] if row else -1
+
+    def has_job(self, project, scope, workflow_id, job_number):
+        """Return True if the job has been recorded as processed."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT 1 FROM jobs WHERE project = ? AND scope = ? AND workflow_id = ? AND job_number = ?',
+                (project, scope, workflow_id, job_number)
+            ).fetchone()
+        return row is not None or job_number <= self.job_number(project, scope, workflow_id)
+
+    def has_scope(self, project, scope):
+        """Return True if any workflow has been recorded for the project and scope."""
+        legacy_prefix = f"{project}-{scope}"
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM jobs WHERE project = ? AND scope = ? LIMIT 1', (project, scope)).fetchone()
+            if not row:
+                row = self.db.execute('SELECT 1 FROM progress WHERE project = ? AND scope = ? LIMIT 1', (project, scope)).fetchone()
+            if not row:
+                # Range query on the primary key index, equivalent to the old startswith() scan
+                row = self.db.execute(
+                    'SELECT 1 FROM legacy_progress WHERE key >= ? AND key < ? LIMIT 1', (legacy_prefix, legacy_prefix + '\uffff')
+                ).fetchone()
+        return row is not None
+
+    def record(self, project, scope, workflow_id, job_number):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?)', (project, scope, workflow_id, job_number))
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.db.commit()
+                self.pending = 0
+
+    def pipeline_watermark(self, project):
+        """Return the newest pipeline number fully processed for a project, or -1."""
+        with self.lock:
+            row = self.db.execute('SELECT pipeline_number FROM watermarks WHERE project = ?', (project,)).fetchone()
+        return row[0] if row else -1
+
+    def set_pipeline_watermark(self, project, pipeline_number):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?)', (project, pipeline_number))
+            self.db.commit()
+
+    def artifact_watermark(self, repo):
+        """Return the creation time (ISO 8601) of the newest artifact fully processed for a repository, or None."""
+        with self.lock:
+            row = self.db.execute('SELECT created_at FROM artifact_watermarks WHERE repo = ?', (repo,)).fetchone()
+        return row[0] if row else None
+
+    def set_artifact_watermark(self, repo, created_at):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO artifact_watermarks VALUES (?, ?)', (repo, created_at))
+            self.db.commit()
+
+    def merge(self, path):
+        """Fold the progress recorded in another store, e.g. by a shard worker, into this one, keeping the highest numbers."""
+        with self.lock:
+            self.db.commit()
+            self.db.execute('ATTACH DATABASE ? AS other', (path,))
+            try:
+                self.db.execute(
+                    'INSERT INTO progress SELECT * FROM other.progress WHERE true '
+                    'ON CONFLICT (project, scope, workflow_id) DO UPDATE SET job_number = max(job_number, excluded.job_number)'
+                )
+                self.db.execute(
+                    'INSERT INTO watermarks SELECT * FROM other.watermarks WHERE true '
+                    'ON CONFLICT (project) DO UPDATE SET pipeline_number = max(pipeline_number, excluded.pipeline_number)'
+                )
+                self.db.execute(
+                    'INSERT INTO legacy_progress SELECT * FROM other.legacy_progress WHERE true '
+                    'ON CONFLICT (key) DO UPDATE SET job_number = max(job_number, excluded.job_number)'
+                )
+                if self.db.execute("SELECT 1 FROM other.sqlite_master WHERE name = 'jobs'").fetchone():
+                    self.db.execute('INSERT OR IGNORE INTO jobs SELECT * FROM other.jobs')
+                if self.db.execute("SELECT 1 FROM other.sqlite_master WHERE name = 'artifact_watermarks'").fetchone():
+                    self.db.execute(
+                        'INSERT INTO artifact_watermarks SELECT * FROM other.artifact_watermarks WHERE true '
+                        'ON CONFLICT (repo) DO UPDATE SET created_at = max(created_at, excluded.created_at)'
+                    )
+                self.db.commit()
+            finally:
+                self.db.execute('DETACH DATABASE other')
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+
+class ArtifactStore:
+    """Content-addressed store for downloaded artifacts.
+
+    Each distinct content is kept once under ``<root>/.blobs`` by SHA-256
+    digest, and the file name each script has always used is created as a
+    hardlink to its blob (or a copy where hardlinks are not supported).
+    ``<root>/.manifest.sqlite`` maps every name to its digest and size.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.blob_dir = os.path.join(root, '.blobs')
+        os.makedirs(os.path.join(self.blob_dir, 'tmp'), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(root, '.manifest.sqlite'), check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS manifest (name TEXT PRIMARY KEY, digest TEXT, size INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS manifest_digest ON manifest (digest)')
+        self.db.commit()
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def has_blob(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def lookup(self, name):
+        """Return the digest stored for a name, or None if the name has not been saved or its blob is missing."""
+        with self.lock:
+            row = self.db.execute('SELECT digest FROM manifest WHERE name = ?', (name,)).fetchone()
+        return row[0] if row and self.has_blob(row[0]) else None
+
+    def download(self, session, url, name, expected_size=None, **kwargs):
+        """Download a URL into the store under a name and return (digest, size, duplicate, bytes transferred).
+
+        Data goes to a partial file in ``.blobs/tmp`` that survives interrupted
+        connections and interrupted runs. The next attempt resumes it with a
+        Range request when the server answers 206, and starts over otherwise.
+        The result is checked against the size announced by the server and,
+        if given, ``expected_size`` before it is moved into place.
+        """
+        part_path = os.path.join(self.blob_dir, 'tmp', f"{hashlib.sha256(name.encode('utf-8')).hexdigest()}.part")
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers['Accept-Encoding'] = 'identity'  # Byte ranges and sizes must refer to the stored bytes
+        transferred = 0
+
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+            else:
+                headers.pop('Range', None)
+            try:
+                with session.get(url, headers=headers, stream=True, **kwargs) as response:
+                    if response.status_code == 416:
+                        os.remove(part_path)  # The partial file does not match the current content
+                        continue
+                    response.raise_for_status()
+                    hasher = hashlib.sha256()
+                    if response.status_code == 206:
+                        announced_size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+                        with open(part_path, 'rb') as f:
+                            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                                hasher.update(chunk)
+                        mode = 'ab'
+                    else:
+                        announced_size = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+                        mode = 'wb'
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            if bandwidth_limiter:
+                                bandwidth_limiter.consume(len(chunk))
+                            hasher.update(chunk)
+                            write_start = time.monotonic()
+                            f.write(chunk)
+                            metrics.add_time('disk_write', time.monotonic() - write_start)
+                            transferred += len(chunk)
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == DOWNLOAD_RETRIES:
+                    raise
+                print(f"Download of {name} interrupted, resuming: {e}")
+                metrics.increment('download_resumes')
+        else:
+            raise IOError(f"Could not download {name}: server rejected every byte range")
+
+        size = os.path.getsize(part_path)
+        for expected in (announced_size, expected_size):
+            if expected is not None and size != expected:
+                os.remove(part_path)
+                raise IOError(f"Downloaded {size} bytes for {name}, expected {expected}")
+
+        digest = hasher.hexdigest()
+        duplicate = self.has_blob(digest)
+        if duplicate:
+            os.remove(part_path)
+        else:
+            os.makedirs(os.path.dirname(self.blob_path(digest)), exist_ok=True)
+            os.replace(part_path, self.blob_path(digest))
+        self.link(name, digest, size)
+        return digest, size, duplicate, transferred
+
+    def link(self, name, digest, size=None):
+        """Point a name at an existing blob."""
+        path = os.path.join(self.root, name)
+        temp_link = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.link(self.blob_path(digest), temp_link)
+        except OSError:
+            shutil.copyfile(self.blob_path(digest), temp_link)
+        os.replace(temp_link, path)
+        if size is None:
+            size = os.path.getsize(path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?)', (name, digest, size))
+            self.db.commit()
+
+    def entries(self):
+        """Yield (name, digest, size) for every saved name."""
+        with self.lock:
+            rows = self.db.execute('SELECT name, digest, size FROM manifest').fetchall()
+        yield from rows
+
+    def merge(self, root):
+        """Add every file saved in another store, e.g. by a shard worker, under the same names.
+
+        Returns the number of names added. Blobs already present are linked
+        rather than copied again.
+        """
+        other = sqlite3.connect(os.path.join(root, '.manifest.sqlite'))
+        try:
+            rows = other.execute('SELECT name, digest, size FROM manifest').fetchall()
+        finally:
+            other.close()
+        added = 0
+        for name, digest, size in rows:
+            source = os.path.join(root, '.blobs', digest[:2], digest)
+            if not os.path.exists(source):
+                continue
+            if not self.has_blob(digest):
+                os.makedirs(os.path.dirname(self.blob_path(digest)), exist_ok=True)
+                temp_path = f"{self.blob_path(digest)}.tmp"
+                try:
+                    os.link(source, temp_path)
+                except OSError:
+                    shutil.copyfile(source, temp_path)
+                os.replace(temp_path, self.blob_path(digest))
+            self.link(name, digest, size)
+            added += 1
+        return added
+
+
+ZIP_END = struct.Struct('<4s4H2LH')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_END = struct.Struct('<4sQ2H2L4Q')
+ZIP_CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+
+
+def iter_zip_members(path):
+    """Yield (member path, size, compressed size, CRC-32) from a zip's central directory.
+
+    Records are read one at a time from the end of the file, so memory use
+    does not depend on the size of the archive or its number of members, and
+    no member data is read. Directories are skipped. Raises
+    zipfile.BadZipFile if the file is not a zip archive.
+    """
+    with open(path, 'rb') as f:
+        file_size = f.seek(0, os.SEEK_END)
+        tail_size = min(file_size, ZIP_END.size + 0xFFFF)  # The end record is followed by a comment of up to 64 KiB
+        f.seek(file_size - tail_size)
+        tail = f.read(tail_size)
+        end = tail.rfind(b'PK\x05\x06')
+        if end < 0 or end + ZIP_END.size > len(tail):
+            raise zipfile.BadZipFile(f"{path} has no zip end of central directory record")
+        _, _, _, _, entries, directory_size, directory_offset, _ = ZIP_END.unpack_from(tail, end)
+        end_offset = file_size - tail_size + end
+        # Data prepended to the archive shifts every offset recorded in it
+        base = end_offset - directory_size - directory_offset
+        if entries == 0xFFFF or directory_size == 0xFFFFFFFF or directory_offset == 0xFFFFFFFF:
+            f.seek(end_offset - ZIP64_LOCATOR.size)
+            signature, _, zip64_end_offset, _ = ZIP64_LOCATOR.unpack(f.read(ZIP64_LOCATOR.size))
+            if signature != b'PK\x06\x07':
+                raise zipfile.BadZipFile(f"{path} has no zip64 end of central directory locator")
+            f.seek(zip64_end_offset)
+            record = ZIP64_END.unpack(f.read(ZIP64_END.size))
+            if record[0] != b'PK\x06\x06':
+                raise zipfile.BadZipFile(f"{path} has no zip64 end of central directory record")
+            entries, directory_size, directory_offset = record[7], record[8], record[9]
+            base = 0
+
+        f.seek(base + directory_offset)
+        for _ in range(entries):
+            header = f.read(ZIP_CENTRAL_HEADER.size)
+            if len(header) < ZIP_CENTRAL_HEADER.size or header[:4] != b'PK\x01\x02':
+                raise zipfile.BadZipFile(f"{path} has a truncated central directory")
+            (_, _, _, flags, _, _, _, crc, compressed_size, size,
+             name_length, extra_length, comment_length, _, _, _, _) = ZIP_CENTRAL_HEADER.unpack(header)
+            name = f.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437', 'replace')
+            extra = f.read(extra_length)
+            f.seek(comment_length, os.SEEK_CUR)
+            # Sizes that do not fit 32 bits are in the zip64 extra field, in this order
+            position = 0
+            while position + 4 <= len(extra):
+                field_id, field_length = struct.unpack_from('<2H', extra, position)
+                if field_id == 0x0001:
+                    values = iter(struct.unpack_from(f'<{field_length // 8}Q', extra, position + 4))
+                    if size == 0xFFFFFFFF:
+                        size = next(values)
+                    if compressed_size == 0xFFFFFFFF:
+                        compressed_size = next(values)
+                    break
+                position += 4 + field_length
+            if not name.endswith('/'):
+                yield name, size, compressed_size, crc
+
+
+class ArtifactIndex:
+    """SQLite index of the files inside downloaded zip artifacts.
+
+    Members are recorded once per distinct archive content (its SHA-256
+    digest, as in ArtifactStore), and every downloaded artifact with that
+    content is recorded as an origin with its repository, workflow run and
+    artifact ID. find() matches member paths exactly or with a glob and
+    streams the results from the database.
+    """
+
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.lock = threading.Lock()
+        self.batch_size = batch_size
+        self.indexing = set()  # Digests being indexed by another thread
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS archives (digest TEXT PRIMARY KEY, members INTEGER, error TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS members (digest TEXT, path TEXT, size INTEGER, compressed_size INTEGER, crc INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS members_path ON members (path)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS members_digest ON members (digest)')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS origins ('
+            'name TEXT PRIMARY KEY, digest TEXT, repo TEXT, run_id INTEGER, artifact_id INTEGER, artifact_name TEXT)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS origins_digest ON origins (digest)')
+        self.db.commit()
+
+    def has_origin(self, name):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM origins WHERE name = ?', (name,)).fetchone() is not None
+
+    def add(self, path, digest, name, repo=None, run_id=None, artifact_id=None, artifact_name=None):
+        """Record the origin of a stored archive and index its members unless that content is already indexed.
+
+        Returns the number of members newly indexed. An archive that cannot be
+        read is recorded with its error rather than raising.
+        """
+        with self.lock:
+            indexed = digest in self.indexing or self.db.execute('SELECT 1 FROM archives WHERE digest = ?', (digest,)).fetchone()
+            if not indexed:
+                self.indexing.add(digest)
+        count = 0
+        if not indexed:
+            # Members are read outside the lock in batches, so only one batch is held at a time
+            error = None
+            batch = []
+            try:
+                for member in iter_zip_members(path):
+                    batch.append((digest,) + member)
+                    if len(batch) >= self.batch_size:
+                        self.write_members(batch)
+                        count += len(batch)
+                        batch = []
+            except (OSError, zipfile.BadZipFile, struct.error) as e:
+                error = str(e)
+            self.write_members(batch)
+            count += len(batch)
+            with self.lock:
+                self.db.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?)', (digest, count, error))
+                self.indexing.discard(digest)
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO origins VALUES (?, ?, ?, ?, ?, ?)', (name, digest, repo, run_id, artifact_id, artifact_name)
+            )
+            self.db.commit()
+        return count
+
+    def write_members(self, batch):
+        with self.lock:
+            self.db.executemany('INSERT INTO members VALUES (?, ?, ?, ?, ?)', batch)
+            self.db.commit()
+
+    def find(self, pattern, glob=None):
+        """Yield (repo, run ID, artifact ID, artifact name, member path, size, CRC-32) for members matching a path.
+
+        ``pattern`` is compared exactly unless it contains *, ? or [ (or
+        ``glob`` is True), in which case it is matched as a glob over the full
+        member path. Rows are fetched from the database as they are consumed.
+        """
+        if glob is None:
+            glob = any(c in pattern for c in '*?[')
+        # A separate connection keeps a long lookup from blocking writers on self.db
+        db = sqlite3.connect(self.path)
+        try:
+            rows = db.execute(
+                'SELECT o.repo, o.run_id, o.artifact_id, o.artifact_name, m.path, m.size, m.crc '
+                'FROM members m JOIN origins o ON o.digest = m.digest '
+                f"WHERE m.path {'GLOB' if glob else '='} ? ORDER BY m.path",
+                (pattern,)
+            )
+            yield from rows
+        finally:
+            db.close()
+
+    def merge(self, path):
+        """Add the archives and origins indexed in another index, e.g. by a shard worker."""
+        with self.lock:
+            self.db.commit()
+            self.db.execute('ATTACH DATABASE ? AS other', (path,))
+            try:
+                self.db.execute(
+                    'INSERT INTO members SELECT * FROM other.members '
+                    'WHERE digest IN (SELECT digest FROM other.archives WHERE digest NOT IN (SELECT digest FROM archives))'
+                )
+                self.db.execute('INSERT OR IGNORE INTO archives SELECT * FROM other.archives')
+                self.db.execute('INSERT OR REPLACE INTO origins SELECT * FROM other.origins')
+                self.db.commit()
+            finally:
+                self.db.execute('DETACH DATABASE other')
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def parse_size(value):
+    """Parse a byte count with an optional K, M or G suffix, e.g. '500M'."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().removesuffix('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def content_length(session, url):
+    """Return the size a HEAD request reports for a URL, or None if it is not known."""
+    response = session.head(url, allow_redirects=True)
+    if not response.ok or 'Content-Length' not in response.headers:
+        return None
+    return int(response.headers['Content-Length'])
+
+
+class BandwidthLimiter:
+    """Token bucket capping the combined rate of every download thread, in bytes per second."""
+
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.allowance = float(rate)
+        self.last_refill = time.monotonic()
+
+    def consume(self, amount):
+        """Account for bytes just received and sleep off any excess over the rate."""
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.allowance -= amount
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            metrics.add_time('bandwidth_wait', delay)
+            time.sleep(delay)
+
+
+bandwidth_limiter = BandwidthLimiter(parse_size(MAX_BANDWIDTH)) if MAX_BANDWIDTH else None
+
+
+class DownloadPlanner:
+    """Orders the downloads found by a listing pass and holds back what does not fit a disk quota.
+
+    Items are dicts with at least ``group`` (the repository or project),
+    ``size`` in bytes (None if unknown, counted as 0) and ``created_at``
+    (ISO 8601). Policies:
+
+    - listed: the order the listing produced
+    - smallest: smallest first, so the most artifacts fit the quota
+    - newest: newest first
+    - fair: one item per group in turn, each group newest first
+    """
+
+    POLICIES = ('listed', 'smallest', 'newest', 'fair')
+
+    def __init__(self, policy='listed', disk_quota=None, dry_run=False):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown order {policy}, expected one of {', '.join(self.POLICIES)}")
+        self.policy = policy
+        self.disk_quota = disk_quota
+        self.dry_run = dry_run
+
+    @property
+    def active(self):
+        """True if downloads have to wait for the whole listing, rather than start as items are found."""
+        return self.policy != 'listed' or self.disk_quota is not None or self.dry_run
+
+    @property
+    def needs_sizes(self):
+        return self.policy == 'smallest' or self.disk_quota is not None or self.dry_run
+
+    def order(self, items):
+        if self.policy == 'smallest':
+            return sorted(items, key=lambda item: item['size'] or 0)
+        if self.policy == 'newest':
+            return sorted(items, key=lambda item: item['created_at'] or '', reverse=True)
+        if self.policy == 'fair':
+            groups = {}
+            for item in items:
+                groups.setdefault(item['group'], []).append(item)
+            turns = [sorted(group, key=lambda item: item['created_at'] or '', reverse=True) for group in groups.values()]
+            ordered = []
+            for turn in range(max(map(len, turns), default=0)):
+                ordered.extend(group[turn] for group in turns if turn < len(group))
+            return ordered
+        return list(items)
+
+    def plan(self, items):
+        """Return (selected, deferred): the items in download order, and those that would exceed the disk quota."""
+        selected, deferred = [], []
+        total = 0
+        for item in self.order(items):
+            size = item['size'] or 0
+            if self.disk_quota is not None and total + size > self.disk_quota:
+                deferred.append(item)
+                continue
+            total += size
+            selected.append(item)
+        return selected, deferred
+
+    def print_plan(self, selected, deferred, download_dir):
+        """Print the planned volume, per group in a dry run, and what the disk quota holds back."""
+        def volume(items):
+            unknown = sum(1 for item in items if item['size'] is None)
+            megabytes = sum(item['size'] or 0 for item in items) / (1024 * 1024)
+            return f"{len(items)} artifacts, {megabytes:.1f} MB" + (f" ({unknown} of unknown size)" if unknown else '')
+
+        groups = {}
+        for item in selected:
+            groups.setdefault(item['group'], []).append(item)
+        print(f"\nPlan ({self.policy} first): {volume(selected)} from {len(groups)} repositories")
+        if self.dry_run:
+            for group, items in groups.items():
+                print(f"  {group}: {volume(items)}")
+        if deferred:
+            print(f"Deferred by the disk quota of {self.disk_quota / (1024 * 1024):.1f} MB: {volume(deferred)}")
+        os.makedirs(download_dir, exist_ok=True)
+        print(f"Free disk space in {download_dir}: {shutil.disk_usage(download_dir).free / (1024 ** 3):.1f} GB")
+
+    def run(self, items, download, workers):
+        """Call download(item) for the items in order on a pool of threads.
+
+        Yields ``(item, result)`` from the calling thread as each finishes,
+        where ``result`` is the exception raised if the download failed.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(download, item): item for item in items}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                yield futures[future], result
+
+
+def add_planner_arguments(parser):
+    parser.add_argument('--order', choices=DownloadPlanner.POLICIES, default='listed', help='Download order (default: listed)')
+    parser.add_argument('--max-disk', type=parse_size, help='Disk quota for this run, e.g. 20G; artifacts beyond it are left for a later run')
+    parser.add_argument('--max-bandwidth', type=parse_size, help='Combined download rate cap per second, e.g. 10M (default: CI_MAX_BANDWIDTH)')
+    parser.add_argument('--dry-run', action='store_true', help='List everything and print the plan without downloading')
+
+
+def planner_from_args(args):
+    """Return the DownloadPlanner for add_planner_arguments() options, applying --max-bandwidth."""
+    global bandwidth_limiter
+    if args.max_bandwidth:
+        bandwidth_limiter = BandwidthLimiter(args.max_bandwidth)
+    return DownloadPlanner(args.order, args.max_disk, args.dry_run)
+
+
+class ResultSink:
+    """Appends structured audit results to an NDJSON or SQLite file in batches.
+
+    Every record has ``run`` (RESULTS_RUN or the start time of the process),
+    ``source`` (the script), ``kind``, ``repo`` (owner/name), ``item`` and
+    ``value``; ``(source, kind, repo, item)`` identifies what a record is
+    about across runs. Kinds written by the scripts:
+
+    - access: item '', value the access level
+    - workflow: item the workflow file path, value whether pull requests trigger it, plus ``name``
+    - fork_pr: item the pull request URL, value the head repository
+
+    Files ending in .sqlite or .db get a ``results`` table, anything else one
+    JSON object per line. Several runs can share a file.
+    """
+
+    def __init__(self, path, run=None, batch_size=100):
+        self.path = path
+        self.run = run or datetime.now(timezone.utc).isoformat(timespec='microseconds')
+        self.source = os.path.basename(sys.argv[0])
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.batch = []
+        self.db = None
+        if self.is_sqlite(path):
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS results (run TEXT, source TEXT, kind TEXT, repo TEXT, item TEXT, value TEXT, data TEXT)'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS results_run ON results (source, run)')
+            self.db.commit()
+        atexit.register(self.close)
+
+    @staticmethod
+    def is_sqlite(path):
+        return path.endswith(('.sqlite', '.db'))
+
+    def record(self, kind, repo, item, value, **extra):
+        record = dict(run=self.run, source=self.source, kind=kind, repo=repo, item=item, value=value, **extra)
+        with self.lock:
+            self.batch.append(record)
+            if len(self.batch) >= self.batch_size:
+                self.flush_locked()
+
+    def flush_locked(self):
+        if not self.batch:
+            return
+        if self.db:
+            self.db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                (r['run'], r['source'], r['kind'], r['repo'], r['item'], json.dumps(r['value']), json.dumps(r)) for r in self.batch
+            ])
+            self.db.commit()
+        else:
+            # One write per batch, so appends from concurrent workers stay whole lines
+            with open(self.path, 'a') as file:
+                file.write(''.join(json.dumps(r) + '\n' for r in self.batch))
+        self.batch = []
+
+    def close(self):
+        with self.lock:
+            self.flush_locked()
+
+    @classmethod
+    def read(cls, path, source=None, run=None):
+        """Yield the records in a results file, optionally only those of one source and run."""
+        if cls.is_sqlite(path):
+            db = sqlite3.connect(path)
+            try:
+                query, params = 'SELECT data FROM results', []
+                if source is not None:
+                    query, params = query + ' WHERE source = ? AND run = ?', [source, run]
+                for data, in db.execute(query, params):
+                    yield json.loads(data)
+            finally:
+                db.close()
+            return
+        with open(path) as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if source is None or (record['source'] == source and record['run'] == run):
+                    yield record
+
+    @classmethod
+    def runs(cls, path):
+        """Return {source: run IDs} for a results file, oldest first in the order the runs were first recorded.
+
+        Run IDs are not compared, since CI_RESULTS_RUN may be any string.
+        """
+        if cls.is_sqlite(path):
+            db = sqlite3.connect(path)
+            try:
+                rows = db.execute('SELECT source, run FROM results GROUP BY source, run ORDER BY MIN(rowid)').fetchall()
+            finally:
+                db.close()
+        else:
+            # dict keeps the first-seen order of the lines
+            rows = dict.fromkeys((record['source'], record['run']) for record in cls.read(path))
+        runs = {}
+        for source, run in rows:
+            runs.setdefault(source, []).append(run)
+        return runs
+
+
+result_sink = ResultSink(RESULTS_FILE, RESULTS_RUN) if RESULTS_FILE else None
+
+
+def record_result(kind, repo, item, value, **extra):
+    """Add a result to CI_RESULTS_FILE, if it is set. See ResultSink for the kinds."""
+    if result_sink:
+        result_sink.record(kind, repo, item, value, **extra)
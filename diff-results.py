@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Report what changed between two runs recorded through CI_RESULTS_FILE."""
+import argparse
+import ci_common
+import json
+
+def load(path, source, run):
+    """Return the records of one run keyed by what they are about."""
+    return {(r['kind'], r['repo'], r['item']): r for r in ci_common.ResultSink.read(path, source, run)}
+
+def diff_runs(old, new):
+    """Yield a change dict for every new fork PR, newly PR-triggered workflow and changed access level."""
+    for key, record in new.items():
+        kind, repo, item = key
+        previous = old.get(key)
+        if kind == 'fork_pr' and previous is None:
+            yield {'change': 'new_fork_pr', 'repo': repo, 'url': item, 'head': record['value']}
+        elif kind == 'workflow' and record['value'] and not (previous and previous['value']):
+            yield {'change': 'pr_triggered', 'repo': repo, 'path': item, 'name': record.get('name'), 'new_file': previous is None}
+        elif kind == 'access' and (previous is None or previous['value'] != record['value']):
+            yield {'change': 'access', 'repo': repo, 'old': previous and previous['value'], 'new': record['value']}
+    # Repositories that disappeared, or that the token can no longer see
+    for (kind, repo, item), record in old.items():
+        if kind == 'access' and (kind, repo, item) not in new:
+            yield {'change': 'access', 'repo': repo, 'old': record['value'], 'new': None}
+
+def describe(change):
+    if change['change'] == 'new_fork_pr':
+        return f"New fork PR in {change['repo']} from {change['head']}: {change['url']}"
+    if change['change'] == 'pr_triggered':
+        became = 'New workflow triggered' if change['new_file'] else 'Workflow became triggered'
+        return f"{became} by pull requests in {change['repo']}: {change['name']} ({change['path']})"
+    return f"Access to {change['repo']} changed: {change['old'] or 'none'} -> {change['new'] or 'none'}"
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report new fork PRs, newly PR-triggered workflows and access level changes between two runs of '
+                    'get-github-repo-permissions.py or get-github-workflow-PRs.py with CI_RESULTS_FILE set'
+    )
+    parser.add_argument('old', help='Results file of the earlier run; with no NEW, its two latest runs per script are compared')
+    parser.add_argument('new', nargs='?', help='Results file of the later run, its latest run per script is compared')
+    parser.add_argument('--format', choices=('text', 'ndjson'), default='text', help='Output format (default: text)')
+    args = parser.parse_args()
+
+    old_runs = ci_common.ResultSink.runs(args.old)
+    new_runs = ci_common.ResultSink.runs(args.new) if args.new else old_runs
+    for source, runs in sorted(new_runs.items()):
+        new_run = runs[-1]
+        earlier = old_runs.get(source, []) if args.new else runs[:-1]
+        if not earlier:
+            print(f"No earlier run of {source} to compare with")
+            continue
+        old_run = earlier[-1]
+        if args.format == 'text':
+            print(f"{source}: {old_run} -> {new_run}")
+        changes = 0
+        for change in diff_runs(load(args.old, source, old_run), load(args.new or args.old, source, new_run)):
+            changes += 1
+            print(json.dumps(dict(change, source=source)) if args.format == 'ndjson' else f"  {describe(change)}")
+        if args.format == 'text' and not changes:
+            print("  No changes")
+
+if __name__ == '__main__':
+    main()
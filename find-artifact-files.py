@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Find which downloaded GitHub artifacts contain a file, using the index built by get-github-artifacts.py."""
+import argparse
+import ci_common
+import csv
+import os
+import re
+import sys
+
+DOWNLOAD_DIR = 'DownloadedGitArtifacts'
+
+def rebuild(store, index):
+    """Index saved zips that have no origin in the index yet, e.g. downloaded before indexing existed."""
+    for name, digest, _ in store.entries():
+        # get-github-artifacts.py saves artifacts as {repo}-{artifact id}.zip
+        match = re.fullmatch(r'(.+)-(\d+)\.zip', name)
+        if not match or index.has_origin(name):
+            continue
+        members = index.add(store.blob_path(digest), digest, name, match.group(1), None, int(match.group(2)))
+        if members:
+            print(f"Indexed {members} files in {name}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Look up files inside downloaded GitHub artifacts by path or glob, without extracting them')
+    parser.add_argument('patterns', nargs='*', help="Member paths, or globs such as '*/junit*.xml' (* also matches /)")
+    parser.add_argument('--dir', default=DOWNLOAD_DIR, help=f'Download directory of get-github-artifacts.py (default: {DOWNLOAD_DIR})')
+    parser.add_argument('--glob', action='store_true', help='Treat every pattern as a glob, even without wildcards')
+    parser.add_argument('--rebuild', action='store_true', help='First index saved artifacts missing from the index')
+    args = parser.parse_args()
+
+    index_path = os.path.join(args.dir, '.index.sqlite')
+    if not args.rebuild and not os.path.exists(index_path):
+        parser.error(f"No index in {args.dir}, run get-github-artifacts.py or use --rebuild")
+    index = ci_common.ArtifactIndex(index_path)
+    if args.rebuild:
+        rebuild(ci_common.ArtifactStore(args.dir), index)
+
+    writer = csv.writer(sys.stdout, delimiter='\t', lineterminator='\n')
+    writer.writerow(['repo', 'run_id', 'artifact_id', 'artifact', 'path', 'size', 'crc32'])
+    for pattern in args.patterns:
+        for repo, run_id, artifact_id, artifact_name, path, size, crc in index.find(pattern, args.glob or None):
+            writer.writerow([repo, run_id or '', artifact_id, artifact_name or '', path, size, f"{crc:08x}"])
+    index.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,126 +1,174 @@
 #!/usr/bin/env python3
+import argparse
+import ci_common
 import os
-import requests
 import hashlib
-import json
+from functools import partial
 
 # Configuration
 GITHUB_ORG = os.getenv('GITHUB_ORG')  # GitHub org
-GITHUB_TOKEN = os.getenv('GITHUB_TOKEN')  # GitHub token
+GITHUB_TOKEN = ci_common.GITHUB_TOKEN  # GitHub token, see GITHUB_TOKENS in ci_common.py for a pool
 CIRCLECI_TOKEN = os.getenv('CIRCLECI_TOKEN')  # CircleCI token
 
 if not GITHUB_TOKEN or not CIRCLECI_TOKEN:
     raise ValueError("GitHub or CircleCI token not found. Please set the GITHUB_TOKEN and CIRCLECI_TOKEN environment variables.")
 
-GITHUB_API_URL = 'https://api.github.com'
-CIRCLECI_API_URL = 'https://circleci.com/api/v2'
+CIRCLECI_URL = os.getenv('CIRCLECI_URL', 'https://circleci.com')
+CIRCLECI_API_URL = f'{CIRCLECI_URL}/api/v2'
 DOWNLOAD_DIR = 'CircleArtifacts'
-PROGRESS_FILE = 'download_progress.json'
+PROGRESS_FILE = 'download_progress.sqlite'
+LEGACY_PROGRESS_FILE = 'download_progress.json'
+WORKERS = int(os.getenv('CIRCLECI_WORKERS', '8'))  # Concurrent requests per level of the project tree
 
-github_session = requests.Session()
-github_session.headers.update({'Authorization': f'token {GITHUB_TOKEN}', 'Accept': 'application/vnd.github.v3+json'})
-
-circleci_session = requests.Session()
+circleci_session = ci_common.RateLimitedSession()
 circleci_session.auth = (CIRCLECI_TOKEN, '')
 circleci_session.headers.update({'Accept': 'application/json'})
 
+progress_store = ci_common.ProgressStore(PROGRESS_FILE, LEGACY_PROGRESS_FILE)
+
+artifact_store = ci_common.ArtifactStore(DOWNLOAD_DIR)
+
 def hash_filename(filename):
     name, extension = os.path.splitext(filename)
     hasher = hashlib.md5()
     hasher.update(name.encode('utf-8'))
     return f"{hasher.hexdigest()}{extension}"
 
-def read_progress():
-    if os.path.exists(PROGRESS_FILE):
-        with open(PROGRESS_FILE, 'r') as file:
-            return json.load(file)
-    return {}
-
 def write_progress(project_slug, pipeline_id, workflow_id, job_number):
-    progress = read_progress()
-    progress_key = f"{project_slug}-{pipeline_id}-{workflow_id}"
-    progress[progress_key] = job_number
-    with open(PROGRESS_FILE, 'w') as file:
-        json.dump(progress, file)
+    progress_store.record(project_slug, pipeline_id, workflow_id, job_number)
 
 def has_completed(project_slug, pipeline_id, workflow_id, job_number):
-    progress = read_progress()
-    progress_key = f"{project_slug}-{pipeline_id}-{workflow_id}"
-    return progress.get(progress_key, -1) >= job_number
-
-def get_github_repositories(org_name):
-    repos = []
-    page = 1
-    while True:
-        repos_url = f"{GITHUB_API_URL}/orgs/{org_name}/repos?per_page=100&page={page}"
-        resp = github_session.get(repos_url)
-        resp.raise_for_status()
-        current_page_repos = resp.json()
-        if not current_page_repos:
-            break  # Exit the loop if there are no repositories on this page
-        repos.extend([repo['name'] for repo in current_page_repos])
-        
-        # Check if 'Link' header is present and if it contains a 'next' relation
-        if "next" not in resp.links:
-            break  # Exit the loop if there's no 'next' page
-        page += 1
-    return repos
-
-def download_artifacts_for_project(project_slug):
-    print(f"\nProcessing project: {project_slug}")
-    
-    pipelines_url = f'{CIRCLECI_API_URL}/project/gh/{project_slug}/pipeline'
-    pipelines_resp = circleci_session.get(pipelines_url)
-    
-    if not pipelines_resp.ok:
-        print(f"No pipelines found or access denied for: {project_slug}")
-        return
-
-    pipelines = pipelines_resp.json().get('items', [])
-    
-    for pipeline in pipelines:
-        workflows_url = f"{CIRCLECI_API_URL}/pipeline/{pipeline['id']}/workflow"
-        workflows_resp = circleci_session.get(workflows_url)
-        workflows = workflows_resp.json().get('items', [])
-
-        for workflow in workflows:
-            jobs_url = f"{CIRCLECI_API_URL}/workflow/{workflow['id']}/job"
-            jobs_resp = circleci_session.get(jobs_url)
-            jobs = jobs_resp.json().get('items', [])
-
-            for job in jobs:
-                if 'job_number' in job:
-                    if has_completed(project_slug, pipeline['id'], workflow['id'], job['job_number']):
-                        print(f"Skipping already downloaded job {job['job_number']} in {project_slug}")
-                        continue
-
-                    artifacts_url = f"{CIRCLECI_API_URL}/project/gh/{project_slug}/{job['job_number']}/artifacts"
-                    artifacts_resp = circleci_session.get(artifacts_url)
-                    artifacts = artifacts_resp.json().get('items', [])
-                    total_artifacts = len(artifacts)
-
-                    for i, artifact in enumerate(artifacts, 1):
-                        print(f"\nDownloading artifact {i} of {total_artifacts} for job {job['job_number']}: {artifact['path']}")
-                        download_resp = circleci_session.get(artifact['url'], stream=True)
-
-                        hashed_filename = hash_filename(f"{project_slug}-{job['job_number']}-{artifact['path']}")
-                        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-                        file_path = os.path.join(DOWNLOAD_DIR, hashed_filename)
-
-                        with open(file_path, 'wb') as f:
-                            for chunk in download_resp.iter_content(chunk_size=8192):
-                                f.write(chunk)
-
-                        print(f"Saved to {file_path}")
-                    
-                    write_progress(project_slug, pipeline['id'], workflow['id'], job['job_number'])
+    return progress_store.has_job(project_slug, pipeline_id, workflow_id, job_number)
+
+def artifact_filename(project_slug, job, artifact):
+    return hash_filename(f"{project_slug}-{job['job_number']}-{artifact['path']}")
+
+def list_job_artifacts(path, fetch_sizes=False):
+    """Return the artifacts of a job with their position in the job, or None if the job was already downloaded."""
+    project_slug, pipeline, workflow, job = path
+    if has_completed(project_slug, pipeline['id'], workflow['id'], job['job_number']):
+        return None
+
+    artifacts_url = f"{CIRCLECI_API_URL}/project/gh/{project_slug}/{job['job_number']}/artifacts"
+    artifacts = list(ci_common.paginate_circleci(circleci_session, artifacts_url))
+    for index, artifact in enumerate(artifacts, 1):
+        artifact.update(index=index, count=len(artifacts))
+        if fetch_sizes:
+            # The listing has no sizes; artifacts saved by an earlier run take no new space
+            stored = artifact_store.lookup(artifact_filename(project_slug, job, artifact))
+            artifact['size'] = 0 if stored else ci_common.content_length(circleci_session, artifact['url'])
+    return artifacts
+
+def download_job_artifact(path):
+    """Download one artifact of a job and return (file path, duplicate)."""
+    project_slug, _, _, job, artifact = path
+    hashed_filename = artifact_filename(project_slug, job, artifact)
+    _, _, duplicate, _ = artifact_store.download(circleci_session, artifact['url'], hashed_filename)
+    return os.path.join(DOWNLOAD_DIR, hashed_filename), duplicate
 
 def main():
-    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-    repositories = get_github_repositories(GITHUB_ORG)
+    parser = argparse.ArgumentParser(description='Download the artifacts of every CircleCI job in the projects of a GitHub organization')
+    ci_common.add_planner_arguments(parser)
+    ci_common.add_shard_arguments(parser)
+    args = parser.parse_args()
+    shard = ci_common.Shard(args.shard, args.leases)
+    planner = ci_common.planner_from_args(args)
 
-    for repo in repositories:
-        download_artifacts_for_project(f"{GITHUB_ORG}/{repo}")
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    projects = ci_common.circleci_project_slugs(GITHUB_ORG, GITHUB_TOKEN)
+
+    watermarks = ci_common.PipelineWatermarks(progress_store)
+    levels = [
+        partial(ci_common.list_circleci_pipelines, circleci_session, CIRCLECI_API_URL, progress_store),
+        partial(ci_common.list_circleci_workflows, circleci_session, CIRCLECI_API_URL),
+        partial(ci_common.list_circleci_jobs, circleci_session, CIRCLECI_API_URL),
+        partial(list_job_artifacts, fetch_sizes=planner.needs_sizes),
+    ]
+    if not planner.active:
+        # Without a plan, downloads run as the fifth level of the walk
+        levels.append(download_job_artifact)
+    walker = ci_common.TreeWalker(levels, [WORKERS] * len(levels))
+
+    pending = {}  # Artifacts not yet downloaded per (project, job number)
+    failed_jobs = set()
+    walked = []
+    planned = []
+
+    def finish_project(project_slug):
+        watermarks.commit(project_slug)
+        shard.done(project_slug)
+
+    def finish_artifact(path, result):
+        """Print a download result and record the job once all its artifacts are saved."""
+        project_slug, pipeline, workflow, job, artifact = path
+        key = (project_slug, job['job_number'])
+        if isinstance(result, Exception):
+            print(f"Failed to download {artifact['path']} for job {job['job_number']} in {project_slug}: {result}")
+            failed_jobs.add(key)
+            watermarks.incomplete(project_slug, pipeline['number'])
+        else:
+            file_path, duplicate = result
+            print(f"\nDownloaded artifact {artifact['index']} of {artifact['count']} for job {job['job_number']} in {project_slug}: {artifact['path']}")
+            print(f"Saved to {file_path}{' (duplicate content)' if duplicate else ''}")
+        pending[key] -= 1
+        if not pending[key] and key not in failed_jobs:
+            write_progress(project_slug, pipeline['id'], workflow['id'], job['job_number'])
+
+    # Requests run in the walker's pools; all output and progress writes happen here
+    for depth, path, result in walker.walk(shard.select(projects), on_root_done=None if planner.active else finish_project):
+        project_slug = path[0]
+        if depth == 0:
+            walked.append(project_slug)
+        if depth == 4:
+            finish_artifact(path, result)
+            continue
+        if isinstance(result, Exception):
+            if depth == 0:
+                print(f"No pipelines found or access denied for: {project_slug}")
+            else:
+                print(f"Failed to process {project_slug} pipeline {path[1]['number']}: {result}")
+                watermarks.incomplete(project_slug, path[1]['number'])
+            continue
+
+        if depth == 0:
+            print(f"\nProcessing project: {project_slug} ({len(result)} new pipelines)")
+            for pipeline in result:
+                watermarks.seen(project_slug, pipeline['number'])
+        elif depth == 1:
+            if any(workflow['status'] in ci_common.CIRCLECI_UNFINISHED_STATUSES for workflow in result):
+                watermarks.incomplete(project_slug, path[1]['number'])
+        elif depth == 3:
+            _, pipeline, workflow, job = path
+            if result is None:
+                print(f"Skipping already downloaded job {job['job_number']} in {project_slug}")
+            elif not result:
+                if not planner.dry_run:
+                    write_progress(project_slug, pipeline['id'], workflow['id'], job['job_number'])
+            else:
+                pending[(project_slug, job['job_number'])] = len(result)
+                if planner.active:
+                    planned.extend({
+                        'group': project_slug,
+                        'name': artifact['path'],
+                        'size': artifact.get('size'),
+                        'created_at': pipeline.get('created_at') or '',
+                        'path': path + (artifact,),
+                    } for artifact in result)
+
+    if not planner.active:
+        return
+    selected, deferred = planner.plan(planned)
+    planner.print_plan(selected, deferred, DOWNLOAD_DIR)
+    if planner.dry_run:
+        return
+    for item in deferred:
+        project_slug, pipeline, _, job, _ = item['path']
+        failed_jobs.add((project_slug, job['job_number']))
+        watermarks.incomplete(project_slug, pipeline['number'])
+    for item, result in planner.run(selected, lambda item: download_job_artifact(item['path']), WORKERS):
+        finish_artifact(item['path'], result)
+    for project_slug in walked:
+        finish_project(project_slug)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
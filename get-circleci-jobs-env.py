@@ -1,36 +1,37 @@
 #!/usr/bin/env python3
 import argparse
+import ci_common
 import hashlib
-import json
 import os
-import requests
+from functools import partial
 from urllib.parse import urlparse, parse_qs
 
 # Configuration
 GITHUB_ORG = os.getenv('GITHUB_ORG')  # GitHub org
-GITHUB_TOKEN = os.getenv('GITHUB_TOKEN')  # GitHub token
+GITHUB_TOKEN = ci_common.GITHUB_TOKEN  # GitHub token, see GITHUB_TOKENS in ci_common.py for a pool
 CIRCLECI_TOKEN = os.getenv('CIRCLECI_TOKEN')  # CircleCI token
 
 if not GITHUB_TOKEN or not CIRCLECI_TOKEN:
     raise ValueError("GitHub or CircleCI token not found. Please set the GITHUB_TOKEN and CIRCLECI_TOKEN environment variables.")
 
-GITHUB_API_URL = 'https://api.github.com'
-CIRCLECI_API_URL = 'https://circleci.com/api/v2'
-PROGRESS_FILE = 'saved_progress.json'
+CIRCLECI_URL = os.getenv('CIRCLECI_URL', 'https://circleci.com')
+CIRCLECI_API_URL = f'{CIRCLECI_URL}/api/v2'
+PROGRESS_FILE = 'saved_progress.sqlite'
+LEGACY_PROGRESS_FILE = 'saved_progress.json'
+WORKERS = int(os.getenv('CIRCLECI_WORKERS', '8'))  # Concurrent requests per level of the project tree
 
-github_session = requests.Session()
-github_session.headers.update({'Authorization': f'token {GITHUB_TOKEN}', 'Accept': 'application/vnd.github.v3+json'})
-
-circleci_session = requests.Session()
+circleci_session = ci_common.RateLimitedSession()
 circleci_session.auth = (CIRCLECI_TOKEN, '')
 circleci_session.headers.update({'Accept': 'application/json'})
 
+progress_store = ci_common.ProgressStore(PROGRESS_FILE, LEGACY_PROGRESS_FILE)
+
 def authenticate_to_circleci(username, password):
-    # Initialize a requests session
-    session = requests.Session()
+    # Login keeps its own cookies, but is paced and recorded in the metrics like the API calls
+    session = ci_common.RateLimitedSession(rotate_tokens=False)
 
     # Send a GET request to the CircleCI login page and follow redirects to /u/login?state
-    login_url = "https://circleci.com/auth/login"
+    login_url = f"{CIRCLECI_URL}/auth/login"
     response = session.get(login_url, allow_redirects=True)
     login_url_with_state = response.url
     parsed_url = urlparse(login_url_with_state)
@@ -44,111 +45,124 @@ def authenticate_to_circleci(username, password):
     # Return authenticated session
     return session
 
-def get_github_repositories(org_name):
-    repos = []
-    page = 1
-    while True:
-        repos_url = f"{GITHUB_API_URL}/orgs/{org_name}/repos?per_page=100&page={page}"
-        resp = github_session.get(repos_url)
-        resp.raise_for_status()
-        current_page_repos = resp.json()
-        if not current_page_repos:
-            break  # Exit the loop if there are no repositories on this page
-        repos.extend([repo['name'] for repo in current_page_repos])
-        
-        # Check if 'Link' header is present and if it contains a 'next' relation
-        if "next" not in resp.links:
-            break  # Exit the loop if there's no 'next' page
-        page += 1
-    return repos
-
 def get_job_details(project_slug, job_id):
     job_details_url = f"{CIRCLECI_API_URL}/project/{project_slug}/job/{job_id}"
     job_details_resp = circleci_session.get(job_details_url)
     job_details = job_details_resp.json()
     return job_details
 
-def get_workflow_job_vars(project_slug, circleci_app_session):
-    print(f"\n\n\nProcessing project: {project_slug}")
-    
-    pipelines_url = f'{CIRCLECI_API_URL}/project/gh/{project_slug}/pipeline'
-    pipelines_resp = circleci_session.get(pipelines_url)
-
-    if not pipelines_resp.ok:
-        print(f"No pipelines found or access denied for: {project_slug}")
-        return
-
-    pipelines = pipelines_resp.json().get('items', [])
-
-    for pipeline in pipelines:
-        workflows_url = f"{CIRCLECI_API_URL}/pipeline/{pipeline['id']}/workflow"
-        workflows_resp = circleci_session.get(workflows_url)
-        workflows = workflows_resp.json().get('items', [])
+def get_latest_job_output(path, circleci_app_session):
+    """Return (job number, raw output) for the latest job of a workflow, or (job number, None) if already processed."""
+    project_slug, pipeline, workflow = path[0]
+    jobs = list(ci_common.paginate_circleci(circleci_session, f"{CIRCLECI_API_URL}/workflow/{workflow['id']}/job"))
+    if not jobs:
+        return None, None
+
+    latest_job = max(jobs, key=lambda j: j.get('job_number', 0))
+
+    job_number = latest_job.get('job_number', 0)
+
+    if has_completed(project_slug, workflow['name'], workflow['id'], job_number):
+        return job_number, None
+
+    job_env_url = f"{CIRCLECI_URL}/api/private/output/raw/github/{project_slug}/{job_number}/output/0/99"
+    job_env_resp = circleci_app_session.get(job_env_url)
+    return job_number, job_env_resp.text
+
+def get_workflow_job_vars(project_slugs, circleci_app_session, shard=None):
+    shard = shard or ci_common.Shard()
+    watermarks = ci_common.PipelineWatermarks(progress_store)
+    # Only the newest run of each workflow name in a project is processed, so collect those first
+    latest_workflows = {}
+    claimed_slugs = []
+
+    def claim_projects():
+        for project_slug in shard.select(project_slugs):
+            claimed_slugs.append(project_slug)
+            yield project_slug
+
+    walker = ci_common.TreeWalker([
+        partial(ci_common.list_circleci_pipelines, circleci_session, CIRCLECI_API_URL, progress_store),
+        partial(ci_common.list_circleci_workflows, circleci_session, CIRCLECI_API_URL),
+    ], [WORKERS] * 2)
+    for depth, path, result in walker.walk(claim_projects()):
+        project_slug = path[0]
+        if isinstance(result, Exception):
+            if depth == 0:
+                print(f"No pipelines found or access denied for: {project_slug}")
+            else:
+                print(f"Failed to list workflows for {project_slug} pipeline {path[1]['number']}: {result}")
+                watermarks.incomplete(project_slug, path[1]['number'])
+            continue
+
+        if depth == 0:
+            print(f"\n\n\nProcessing project: {project_slug} ({len(result)} new pipelines)")
+            for pipeline in result:
+                watermarks.seen(project_slug, pipeline['number'])
+            continue
+
+        pipeline = path[1]
+        for workflow in result:
+            if workflow['status'] in ci_common.CIRCLECI_UNFINISHED_STATUSES:
+                watermarks.incomplete(project_slug, pipeline['number'])
 
-        for workflow in workflows:
             if seen_workflow(project_slug, workflow['name']):
                 print(f"Skipping already processed workflow {workflow['name']} in {project_slug}")
                 continue
 
-            print(f"\nProject: {project_slug}")
-            print(f"Workflow: {workflow['name']} ({workflow['id']})")
-            print(f"Trigger: {pipeline['trigger']['type']}")
-            jobs_url = f"{CIRCLECI_API_URL}/workflow/{workflow['id']}/job"
-            jobs_resp = circleci_session.get(jobs_url)
-            jobs = jobs_resp.json().get('items', [])
-
-            latest_job = max(jobs, key=lambda j: j.get('job_number', 0))
-
-            job_number = latest_job.get('job_number', 0)
-
-            if has_completed(project_slug, workflow['name'], workflow['id'], job_number):
-                print(f"Skipping already processed job {job_number} in {project_slug}")
-                continue
-
-            print(f"Job: {job_number}")
-            job_env_url = f"https://circleci.com/api/private/output/raw/github/{project_slug}/{job_number}/output/0/99"
-            job_env_resp = circleci_app_session.get(job_env_url)
-            print(job_env_resp.text)
-            write_progress(project_slug, workflow['name'], workflow['id'], job_number)
-            
+            key = (project_slug, workflow['name'])
+            if key not in latest_workflows or latest_workflows[key][1]['number'] < pipeline['number']:
+                latest_workflows[key] = (project_slug, pipeline, workflow)
+
+    walker = ci_common.TreeWalker([lambda path: get_latest_job_output(path, circleci_app_session)], [WORKERS])
+    for _, path, result in walker.walk(latest_workflows.values()):
+        project_slug, pipeline, workflow = path[0]
+        print(f"\nProject: {project_slug}")
+        print(f"Workflow: {workflow['name']} ({workflow['id']})")
+        print(f"Trigger: {pipeline['trigger']['type']}")
+        if isinstance(result, Exception):
+            print(f"Failed to fetch job output: {result}")
+            watermarks.incomplete(project_slug, pipeline['number'])
+            continue
+
+        job_number, output = result
+        if job_number is None:
+            continue
+        if output is None:
+            print(f"Skipping already processed job {job_number} in {project_slug}")
+            continue
+
+        print(f"Job: {job_number}")
+        print(output)
+        write_progress(project_slug, workflow['name'], workflow['id'], job_number)
+
+    for project_slug in claimed_slugs:
+        watermarks.commit(project_slug)
+        shard.done(project_slug)
 
 def has_completed(project_slug, workflow_name, workflow_id, job_number):
-    progress = read_progress()
-    progress_key = f"{project_slug}-{workflow_name}-{workflow_id}"
-    return progress.get(progress_key, -1) >= job_number
-
-def read_progress():
-    if os.path.exists(PROGRESS_FILE):
-        with open(PROGRESS_FILE, 'r') as file:
-            return json.load(file)
-    return {}
+    return progress_store.has_job(project_slug, workflow_name, workflow_id, job_number)
 
 def seen_workflow(project_slug, workflow_name):
-    progress = read_progress()
-    progress_key = f"{project_slug}-{workflow_name}"
-    return any(key.startswith(progress_key) for key in progress)
+    return progress_store.has_scope(project_slug, workflow_name)
 
 def write_progress(project_slug, workflow_name, workflow_id, job_number):
-    progress = read_progress()
-    progress_key = f"{project_slug}-{workflow_name}-{workflow_id}"
-    progress[progress_key] = job_number
-    with open(PROGRESS_FILE, 'w') as file:
-        json.dump(progress, file)
+    progress_store.record(project_slug, workflow_name, workflow_id, job_number)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process CircleCI jobs for GitHub repositories')
     parser.add_argument('-p', help='Specify a CircleCI password')
     parser.add_argument('-r', help='Specify a single repository name to process')
     parser.add_argument('-u', help='Specify a CircleCI username')
+    ci_common.add_shard_arguments(parser)
 
     args = parser.parse_args()
 
     if args.r:
-        repositories = [args.r]
+        project_slugs = [f"{GITHUB_ORG}/{args.r}"]
     else:
-        repositories = get_github_repositories(GITHUB_ORG)
+        project_slugs = ci_common.circleci_project_slugs(GITHUB_ORG, GITHUB_TOKEN)
 
     circleci_app_session = authenticate_to_circleci(args.u, args.p)
 
-    for repo in repositories:
-        get_workflow_job_vars(f"{GITHUB_ORG}/{repo}", circleci_app_session)
\ No newline at end of file
+    get_workflow_job_vars(project_slugs, circleci_app_session, ci_common.Shard(args.shard, args.leases))
\ No newline at end of file
@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
+import argparse
+import ci_common
+import fnmatch
 import os
 import requests
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 
 # Configuration
 GITHUB_ORG = os.getenv('GITHUB_ORG') # GitHub organization
-GITHUB_TOKEN = os.getenv('GITHUB_TOKEN')  # GitHub token
+GITHUB_TOKEN = ci_common.GITHUB_TOKEN  # GitHub token, see GITHUB_TOKENS in ci_common.py for a pool
 
 # The base URL for the GitHub API
-GITHUB_API_URL = 'https://api.github.com'
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+
+DOWNLOAD_DIR = 'DownloadedGitArtifacts'
+PROGRESS_FILE = 'artifact_progress.sqlite'
+INDEX_FILE = os.path.join(DOWNLOAD_DIR, '.index.sqlite')  # Files inside the downloaded zips, see find-artifact-files.py
 
 # Headers to use in the API requests
 headers = {
@@ -15,77 +26,215 @@ headers = {
     'Accept': 'application/vnd.github.v3+json',
 }
 
+artifact_store = ci_common.ArtifactStore(DOWNLOAD_DIR)
+artifact_index = ci_common.ArtifactIndex(INDEX_FILE)
+
 def get_repos(org_name):
     print(f"Retrieving repositories for organization: {org_name}")
-    repos = []
-    page = 1
-    while True:
-        repos_url = f"{GITHUB_API_URL}/orgs/{org_name}/repos?per_page=100&page={page}"
-        resp = requests.get(repos_url, headers=headers)
-        resp.raise_for_status()
-        current_page_repos = resp.json()
-        if not current_page_repos:
-            break  # Exit the loop if there are no repositories on this page
-        repos.extend([repo['name'] for repo in current_page_repos])
-        
-        # Check if 'Link' header is present and if it contains a 'next' relation
-        if "next" not in resp.links:
-            break  # Exit the loop if there's no 'next' page
-        page += 1
-    return repos
-
-def get_artifacts(repo_name):
-    """Retrieve all artifacts for the given repository."""
+    return [repo['name'] for repo in ci_common.get_repo_inventory(org_name, GITHUB_TOKEN)]
+
+def parse_time(value):
+    """Normalize an ISO 8601 date or time to the UTC format GitHub uses, so that times compare as strings."""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def get_artifacts(repo_name, name=None, created_after=None):
+    """Retrieve the artifacts of the given repository and whether the listing completed.
+
+    GitHub lists artifacts newest first, so paging stops at the first page
+    reaching back before ``created_after``. ``name`` is matched by the API.
+    """
     print(f"Retrieving artifacts for repository: {repo_name}")
     artifacts = []
     url = f"{GITHUB_API_URL}/repos/{GITHUB_ORG}/{repo_name}/actions/artifacts"
+    params = {'per_page': 100, 'name': name}
     while url:
         try:
-            response = requests.get(url, headers=headers)
+            response = ci_common.get(url, headers=headers, params=params)
             response.raise_for_status()
-            artifacts.extend(response.json().get('artifacts', []))
-            print(f"Found {len(response.json().get('artifacts', []))} artifacts")
+            page = response.json().get('artifacts', [])
+            artifacts.extend(page)
+            print(f"Found {len(page)} artifacts")
+            if created_after and any(artifact['created_at'] < created_after for artifact in page):
+                break
             url = response.links.get('next', {}).get('url')
+            params = None  # The next link carries them
         except requests.HTTPError as e:
             print(f"Failed to retrieve artifacts for {repo_name}: {e}")
-            break
-    return artifacts
+            return artifacts, False
+    if created_after:
+        artifacts = [artifact for artifact in artifacts if artifact['created_at'] >= created_after]
+    return artifacts, True
+
+def plan_item(artifact, repo_name, planned_digests):
+    """Describe an artifact for the DownloadPlanner; content already stored or planned costs no disk space."""
+    digest = (artifact.get('digest') or '').removeprefix('sha256:')
+    stored = artifact_store.lookup(f"{repo_name}-{artifact['id']}.zip") or (digest and (artifact_store.has_blob(digest) or digest in planned_digests))
+    if digest:
+        planned_digests.add(digest)
+    return {
+        'group': repo_name,
+        'size': 0 if stored else artifact.get('size_in_bytes'),
+        'created_at': artifact.get('created_at'),
+        'artifact': artifact,
+    }
+
+def skip_reason(artifact, args):
+    """Return why an artifact is not downloaded, or None if it passes every filter."""
+    if artifact.get('expired'):
+        return 'expired'
+    if args.name and not any(fnmatch.fnmatchcase(artifact['name'], pattern) for pattern in args.name):
+        return 'name'
+    size = artifact.get('size_in_bytes') or 0
+    if args.min_size is not None and size < args.min_size or args.max_size is not None and size > args.max_size:
+        return 'size'
+    if args.run_id and (artifact.get('workflow_run') or {}).get('id') not in args.run_id:
+        return 'workflow run'
+    return None
+
+def index_artifact(artifact, repo_name, filename, digest):
+    """Record the files inside a saved artifact; archives with content indexed before are not read again."""
+    members = artifact_index.add(
+        artifact_store.blob_path(digest), digest, filename, repo_name,
+        (artifact.get('workflow_run') or {}).get('id'), artifact['id'], artifact.get('name')
+    )
+    if members:
+        print(f"Indexed {members} files in {filename}")
 
 def download_artifact(artifact, repo_name):
-    """Download the given artifact."""
-    url = artifact['archive_download_url']
+    """Download the given artifact and return the number of bytes transferred, or None if it failed."""
+    filename = f"{repo_name}-{artifact['id']}.zip"
+    stored_digest = artifact_store.lookup(filename)
+    if stored_digest:
+        print(f"Already downloaded {filename}")
+        index_artifact(artifact, repo_name, filename, stored_digest)
+        return 0
+
+    # Artifacts uploaded with actions/upload-artifact v4+ report their SHA-256 up front
+    digest = (artifact.get('digest') or '').removeprefix('sha256:')
+    if digest and artifact_store.has_blob(digest):
+        artifact_store.link(filename, digest, artifact.get('size_in_bytes'))
+        print(f"Linked {filename} to identical content already downloaded")
+        index_artifact(artifact, repo_name, filename, digest)
+        return 0
+
+    # size_in_bytes is only the archive size for artifacts that also report a digest
+    expected_size = artifact.get('size_in_bytes') if digest else None
     try:
-        response = requests.get(url, headers=headers, stream=True)
-        response.raise_for_status()
-
-        # Extract filename from URL and create a directory for it
-        filename = f"{repo_name}-{artifact['id']}.zip"
-        download_dir = 'DownloadedGitArtifacts'
-        os.makedirs(download_dir, exist_ok=True)
-        filepath = os.path.join(download_dir, filename)
-
-        # Save the artifact to a file
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        print(f"Downloaded {filename}")
-    except requests.HTTPError as e:
+        digest, _, duplicate, transferred = artifact_store.download(
+            ci_common.default_session, artifact['archive_download_url'], filename, expected_size, headers=headers
+        )
+        print(f"Downloaded {filename}{' (duplicate content)' if duplicate else ''}")
+        index_artifact(artifact, repo_name, filename, digest)
+        return transferred
+    except (requests.RequestException, OSError) as e:
         print(f"Failed to download artifact {artifact['id']} from {repo_name}: {e}")
+    return None
 
 def main():
+    parser = argparse.ArgumentParser(description='Download all GitHub workflow artifacts for an organization')
+    parser.add_argument('-w', type=int, default=8, help='Number of concurrent downloads (default: 8)')
+    parser.add_argument('--name', action='append', help='Only artifacts whose name matches this glob, may be repeated')
+    parser.add_argument('--min-size', type=ci_common.parse_size, help='Only artifacts of at least this size, e.g. 10K')
+    parser.add_argument('--max-size', type=ci_common.parse_size, help='Only artifacts of at most this size, e.g. 500M')
+    parser.add_argument('--created-after', type=parse_time, help='Only artifacts created at or after this ISO 8601 date or time')
+    parser.add_argument('--run-id', type=int, action='append', help='Only artifacts of this workflow run, may be repeated')
+    parser.add_argument('--since-last-run', action='store_true', help='Only artifacts created since the newest one downloaded by the last run with this option')
+    ci_common.add_planner_arguments(parser)
+    ci_common.add_shard_arguments(parser)
+    args = parser.parse_args()
+    shard = ci_common.Shard(args.shard, args.leases)
+    planner = ci_common.planner_from_args(args)
+    # The watermark covers every artifact listed, so it would pass over artifacts a content filter left out
+    if args.since_last_run and (args.name or args.min_size is not None or args.max_size is not None or args.run_id):
+        parser.error('--since-last-run cannot be combined with --name, --min-size, --max-size or --run-id')
+    progress_store = ci_common.ProgressStore(PROGRESS_FILE)
+    # A single name without wildcards is filtered by the API instead
+    api_name = args.name[0] if args.name and len(args.name) == 1 and not any(c in args.name[0] for c in '*?[') else None
+
     repos = get_repos(GITHUB_ORG)
     if not repos:
         print("No repositories found.")
         return
 
-    for repo in repos:
-        artifacts = get_artifacts(repo)
-        if not artifacts:
-            print(f"No artifacts found for {repo}.")
-            continue
+    start_time = time.monotonic()
+    total_bytes = 0
+    downloads = {}  # Future -> repository
+    pending = {}  # Downloads not yet finished per repository
+    newest = {}  # Creation time of the newest artifact listed per repository
+    failed = set()  # Repositories whose listing or a download failed, their watermark stays put
+    skipped = Counter()
+    planned = []
+    planned_digests = set()
+
+    def finish_repo(repo):
+        if planner.dry_run:
+            return
+        shard.done(repo)
+        if args.since_last_run and repo not in failed and newest.get(repo):
+            progress_store.set_artifact_watermark(repo, newest[repo])
+
+    # Without a plan, downloads for one repository run in the pool while the next repository's artifacts are listed
+    with ThreadPoolExecutor(max_workers=max(1, args.w)) as executor:
+        for repo in shard.select(repos):
+            watermark = progress_store.artifact_watermark(repo) if args.since_last_run else None
+            created_after = max(filter(None, (args.created_after, watermark)), default=None)
+            artifacts, complete = get_artifacts(repo, api_name, created_after)
+            if not complete:
+                failed.add(repo)
+            newest[repo] = max((artifact['created_at'] for artifact in artifacts), default=None)
+
+            selected = []
+            for artifact in artifacts:
+                reason = skip_reason(artifact, args)
+                if reason:
+                    skipped[reason] += 1
+                else:
+                    selected.append(artifact)
+            if not selected:
+                print(f"No {'matching ' if artifacts else ''}artifacts found for {repo}.")
+                finish_repo(repo)
+                continue
+
+            pending[repo] = len(selected)
+            for artifact in selected:
+                if planner.active:
+                    planned.append(plan_item(artifact, repo, planned_digests))
+                else:
+                    downloads[executor.submit(download_artifact, artifact, repo)] = repo
+
+        if planner.active:
+            selected, deferred = planner.plan(planned)
+            planner.print_plan(selected, deferred, DOWNLOAD_DIR)
+            if planner.dry_run:
+                return
+            for item in deferred:
+                failed.add(item['group'])
+                pending[item['group']] -= 1
+                if not pending[item['group']]:
+                    finish_repo(item['group'])
+            # The pool takes submitted downloads in order
+            for item in selected:
+                downloads[executor.submit(download_artifact, item['artifact'], item['group'])] = item['group']
+
+        for future in as_completed(downloads):
+            transferred = future.result()
+            repo = downloads[future]
+            if transferred is None:
+                failed.add(repo)
+            else:
+                total_bytes += transferred
+            pending[repo] -= 1
+            if not pending[repo]:
+                finish_repo(repo)
 
-        for artifact in artifacts:
-            download_artifact(artifact, repo)
+    elapsed = time.monotonic() - start_time
+    rate = total_bytes / elapsed / (1024 * 1024) if elapsed else 0
+    print(f"\nDownloaded {total_bytes / (1024 * 1024):.1f} MB from {len(downloads)} artifacts in {elapsed:.1f}s ({rate:.2f} MB/s)")
+    if skipped:
+        print("Skipped artifacts: " + ", ".join(f"{reason} {count}" for reason, count in skipped.items()))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,46 +1,31 @@
 #!/usr/bin/env python3
+import ci_common
 import os
-import requests
 
 # Constants
-GITHUB_API = "https://api.github.com"
 ORGANIZATION = os.getenv('GITHUB_ORG')
-TOKEN = os.getenv('GITHUB_TOKEN')
+TOKEN = ci_common.GITHUB_TOKEN
 
-# Set up the headers for authentication
-headers = {
-    "Authorization": f"token {TOKEN}",
-    "Accept": "application/vnd.github.v3+json"
+# Inventory permission values mapped to the reported access levels
+GRAPHQL_ACCESS_LEVELS = {
+    "ADMIN": "Admin",
+    "MAINTAIN": "Write",
+    "WRITE": "Write",
+    "TRIAGE": "Read",
+    "READ": "Read",
 }
 
-def get_repositories(org_name):
-    """Retrieve all repositories for the given organization."""
+shard = ci_common.Shard(ci_common.SHARD, ci_common.SHARD_LEASES)
+
+def get_access_levels(org_name):
+    """Yield (repository name, access level) for every repository in the shared inventory."""
     print(f"Retrieving repositories for organization: {org_name}")
-    repos = []
-    url = f"{GITHUB_API}/orgs/{org_name}/repos"
-    while url:
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            repos.extend(response.json())
-            print(f"Found {len(response.json())} repositories")
-            url = response.links.get('next', {}).get('url')
-        except requests.HTTPError as e:
-            print(f"Failed to retrieve repositories: {e}")
-            break
-    return repos
+    for repo in ci_common.get_repo_inventory(org_name, TOKEN):
+        yield repo["name"], GRAPHQL_ACCESS_LEVELS.get(repo["permission"], "None")
 
 # Main execution
-repositories = get_repositories(ORGANIZATION)
-for repo in repositories:
-    repo_name = repo["name"]
-    permissions = repo["permissions"]
+for repo_name, access_level in shard.select(get_access_levels(ORGANIZATION), key=lambda level: level[0]):
     print(f"Repository: {repo_name}")
-    if permissions["admin"]:
-        print("  - Access level: Admin")
-    elif permissions["push"]:
-        print("  - Access level: Write")
-    elif permissions["pull"]:
-        print("  - Access level: Read")
-    else:
-        print("  - Access level: None")
\ No newline at end of file
+    print(f"  - Access level: {access_level}")
+    ci_common.record_result('access', f"{ORGANIZATION}/{repo_name}", '', access_level)
+    shard.done(repo_name)
@@ -1,18 +1,24 @@
 #!/usr/bin/env python3
+import argparse
+import ci_common
+import csv
+import json
 import os
-import requests
 import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-def check_write_access_to_repo(repo_full_name, api_token):
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+
+def get_repo_permissions(repo_full_name, api_token):
     """
-    Check if the given API token has write access to the specified repository.
-    
+    Return the HTTP status and the permissions the given API token has on the specified repository.
+
     :param repo_full_name: Full name of the repository (e.g., 'username/repo').
     :param api_token: GitHub API token.
-    :return: True if write access is present, False otherwise.
+    :return: (status code, permissions dict), the dict is empty unless the status is 200.
     """
     # GitHub API URL for the repository
-    url = f"https://api.github.com/repos/{repo_full_name}"
+    url = f"{GITHUB_API_URL}/repos/{repo_full_name}"
 
     # Headers for authentication
     headers = {
@@ -21,25 +27,111 @@ def check_write_access_to_repo(repo_full_name, api_token):
     }
 
     # Send a GET request to the API
-    response = requests.get(url, headers=headers)
-    
+    # Pinned so the answer is about api_token even when it is part of the GITHUB_TOKENS pool
+    response = ci_common.pinned_session.get(url, headers=headers)
+
     if response.status_code != 200:
-        # If response is not OK, return False
-        return False
+        return response.status_code, {}
 
-    # Parse the JSON response
-    repo_info = response.json()
-    
     # Permissions are included in the response
-    permissions = repo_info.get('permissions', {})
+    return response.status_code, response.json().get('permissions', {})
+
+def check_write_access_to_repo(repo_full_name, api_token):
+    """
+    Check if the given API token has write access to the specified repository.
+    
+    :param repo_full_name: Full name of the repository (e.g., 'username/repo').
+    :param api_token: GitHub API token.
+    :return: True if write access is present, False otherwise.
+    """
+    _, permissions = get_repo_permissions(repo_full_name, api_token)
     return permissions.get('push', False)
 
+def mask_token(token):
+    """Keep only the last four characters, enough to tell the tokens of a batch apart in the output."""
+    return f"...{token[-4:]}"
+
+def read_pairs(file):
+    """Yield (repo, token) from lines of 'owner/repo token', separated by whitespace or a comma, once per pair."""
+    seen = set()
+    for line_number, line in enumerate(file, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.replace(',', ' ').split()
+        if len(fields) != 2 or '/' not in fields[0]:
+            print(f"Skipping malformed line {line_number}: expected 'owner/repo token'", file=sys.stderr)
+            continue
+        repo, token = fields
+        # Repository names are case-insensitive on GitHub
+        if (repo.lower(), token) in seen:
+            continue
+        seen.add((repo.lower(), token))
+        yield repo, token
+
+def check_pair(repo, token):
+    try:
+        status, permissions = get_repo_permissions(repo, token)
+        error = None
+    except Exception as e:
+        status, permissions, error = None, {}, str(e)
+    return {
+        'repo': repo,
+        'token': mask_token(token),
+        'status': status,
+        'write': bool(permissions.get('push', False)),
+        'permission': next((level for flag, level in ci_common.REST_PERMISSIONS if permissions.get(flag)), None),
+        'error': error,
+    }
+
+def check_batch(pairs, workers):
+    """Check pairs concurrently over the shared connection pool and yield results as they finish.
+
+    At most a few times ``workers`` pairs are read ahead, so arbitrarily long
+    input files are streamed.
+    """
+    pairs = iter(pairs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = set()
+        while True:
+            for repo, token in pairs:
+                futures.add(executor.submit(check_pair, repo, token))
+                if len(futures) >= 4 * workers:
+                    break
+            if not futures:
+                return
+            finished, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield future.result()
+
 def main():
-    repo_full_name = sys.argv[1]
-    api_token = sys.argv[2]
+    parser = argparse.ArgumentParser(description='Check whether GitHub tokens have write access to repositories')
+    parser.add_argument('repo', nargs='?', help="Full name of the repository, e.g. 'username/repo'")
+    parser.add_argument('token', nargs='?', help='GitHub API token')
+    parser.add_argument('--batch', metavar='FILE', help="Check every 'owner/repo token' line of FILE ('-' for stdin) instead")
+    parser.add_argument('--format', choices=('csv', 'ndjson'), default='csv', help='Output format of --batch (default: csv)')
+    parser.add_argument('-w', type=int, default=ci_common.MAX_CONNECTIONS_PER_HOST, help='Concurrent checks in --batch mode (default: CI_MAX_CONNECTIONS_PER_HOST)')
+    args = parser.parse_args()
+
+    if not args.batch:
+        if not args.repo or not args.token:
+            parser.error('a repository and a token are required without --batch')
+        has_write_access = check_write_access_to_repo(args.repo, args.token)
+        print("Has write access" if has_write_access else "No write access")
+        return
 
-    has_write_access = check_write_access_to_repo(repo_full_name, api_token)
-    print("Has write access" if has_write_access else "No write access")
+    fields = ['repo', 'token', 'status', 'write', 'permission', 'error']
+    writer = csv.DictWriter(sys.stdout, fields, lineterminator='\n') if args.format == 'csv' else None
+    if writer:
+        writer.writeheader()
+    file = sys.stdin if args.batch == '-' else open(args.batch, 'r')
+    with file:
+        for result in check_batch(read_pairs(file), max(1, args.w)):
+            if writer:
+                writer.writerow(result)
+            else:
+                print(json.dumps(result))
+            sys.stdout.flush()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,80 +1,128 @@
 #!/usr/bin/env python3
-import requests
+import ci_common
+import os
+import sqlite3
 import traceback
 import yaml
 
 org = os.getenv('GITHUB_ORG')
 specific_repo = "" # for testing
-token = os.getenv('GITHUB_TOKEN')
+token = ci_common.GITHUB_TOKEN
 
-def get_default_branch(repo_name, org, headers):
-    repo_url = f"https://api.github.com/repos/{org}/{repo_name}"
-    response = requests.get(repo_url, headers=headers)
-    return response.json().get("default_branch", "master") if response.status_code == 200 else "master"
+TRIGGER_CACHE_FILE = 'workflow_triggers.sqlite'
 
-def get_raw_workflow_url(repo_name, workflow_path, org, default_branch):
-    return f"https://raw.githubusercontent.com/{org}/{repo_name}/{default_branch}/{workflow_path}"
+# Use the libyaml C parser when PyYAML was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
-def get_workflow_file(url, headers):
-    response = requests.get(url, headers=headers)
-    return response.text if response.status_code == 200 else None
+WORKFLOW_FILES_QUERY = """
+query($owner: String!, $name: String!, $expression: String!) {
+  repository(owner: $owner, name: $name) {
+    object(expression: $expression) {
+      ... on Tree { entries { name path oid object { ... on Blob { text } } } }
+    }
+  }
+}
+"""
+
+# Parse results keyed by blob SHA, so a workflow file is only parsed again when its content changes
+trigger_cache = sqlite3.connect(TRIGGER_CACHE_FILE)
+trigger_cache.execute('CREATE TABLE IF NOT EXISTS triggers (sha TEXT PRIMARY KEY, name TEXT, pr_triggered INTEGER)')
+
+def get_workflow_files(org, repo_name, default_branch, token):
+    """Return (path, blob SHA, content) for every workflow file in a repository with a single GraphQL query."""
+    variables = {'owner': org, 'name': repo_name, 'expression': f"{default_branch}:.github/workflows"}
+    repository = ci_common.graphql(WORKFLOW_FILES_QUERY, variables, token)['repository']
+    tree = repository and repository['object']
+    if not tree:
+        return []
+    return [
+        (entry['path'], entry['oid'], (entry['object'] or {}).get('text'))
+        for entry in tree['entries'] if entry['name'].endswith(('.yml', '.yaml'))
+    ]
+
+def is_pr_triggered_workflow(workflow_yaml):
+    # The 'True' key is used because the 'on' YAML key translates to a Python True boolean
+    on_content = workflow_yaml.get(True, {})
+
+    # Check if 'pull_request' key exists, regardless of its value
+    if 'pull_request' in on_content:
+        return True
+    return False
+
+def parse_workflow(path, sha, workflow_content):
+    """Return (workflow name, triggered by PRs) for a workflow file, using the cached result for a known blob SHA."""
+    cached = trigger_cache.execute('SELECT name, pr_triggered FROM triggers WHERE sha = ?', (sha,)).fetchone()
+    if cached:
+        return cached[0], bool(cached[1])
 
-def is_pr_triggered_workflow(workflow_content):
     try:
-        workflow_yaml = yaml.safe_load(workflow_content)
-        # The 'True' key is used because the 'on' YAML key translates to a Python True boolean
-        on_content = workflow_yaml.get(True, {})
-        
-        # Check if 'pull_request' key exists, regardless of its value
-        if 'pull_request' in on_content:
-            return True
-        return False
+        workflow_yaml = yaml.load(workflow_content, Loader=YamlLoader)
     except yaml.YAMLError as exc:
         print(f"Error parsing YAML: {exc}")
-        return False
+        workflow_yaml = None
+    if isinstance(workflow_yaml, dict):
+        name = str(workflow_yaml.get('name', path))
+        pr_triggered = is_pr_triggered_workflow(workflow_yaml)
+    else:
+        name, pr_triggered = path, False
 
-def get_fork_pr_urls(org, token, specific_repo=None):
+    trigger_cache.execute('INSERT OR REPLACE INTO triggers VALUES (?, ?, ?)', (sha, name, int(pr_triggered)))
+    trigger_cache.commit()
+    return name, pr_triggered
+
+def check_repo(org, repo, token):
+    """Print the fork PRs of a repository that has PR-triggered workflows."""
     headers = {'Authorization': f'token {token}'}
-    page = 1
-    while True:
-        repos_url = f"https://api.github.com/orgs/{org}/repos?type=public&per_page=100&page={page}&sort=full_name"
-        repos_response = requests.get(repos_url, headers=headers)
-        if repos_response.status_code != 200:
-            raise Exception(f"Failed to fetch repos: {repos_response.status_code}")
-        repos = repos_response.json()
-        if not repos:
-            break
-        for repo in sorted(repos, key=lambda r: r['name'].lower()):
-            if specific_repo and repo['name'].lower() != specific_repo.lower():
-                continue
-            print(f"  Checking workflows for repository: {repo['name']}")
-            default_branch = get_default_branch(repo['name'], org, headers)
-            workflows_url = f"https://api.github.com/repos/{org}/{repo['name']}/actions/workflows"
-            workflows_response = requests.get(workflows_url, headers=headers)
-            if workflows_response.status_code != 200:
-                print(f"  Failed to fetch workflows for repo {repo['name']}")
+    full_name = f"{org}/{repo['name']}"
+    print(f"  Checking workflows for repository: {repo['name']}")
+    try:
+        workflow_files = get_workflow_files(org, repo['name'], repo['default_branch'], token)
+    except Exception as e:
+        print(f"  Failed to fetch workflows for repo {repo['name']}: {e}")
+        return
+
+    prs = None  # Fetched on the first PR-triggered workflow and shared by the rest
+    for path, sha, workflow_file_content in workflow_files:
+        print(f"    Checking workflow file: {path}")
+        if workflow_file_content is None:
+            print(f"        Workflow is not triggered by PR")
+            ci_common.record_result('workflow', full_name, path, False, name=path)
+            continue
+        workflow_name, pr_triggered = parse_workflow(path, sha, workflow_file_content)
+        ci_common.record_result('workflow', full_name, path, pr_triggered, name=workflow_name)
+        if not pr_triggered:
+            print(f"        Workflow is not triggered by PR")
+            continue
+
+        print(f"        Workflow {workflow_name} in {repo['name']} is triggered by pull requests.")
+        if prs is None:
+            prs_url = f"{ci_common.GITHUB_API_URL}/repos/{org}/{repo['name']}/pulls"
+            print(f"        Fetching PRs in forks of repository: {repo['name']}")
+            prs_response = ci_common.get(prs_url, headers=headers)
+            if prs_response.status_code != 200:
+                print(f"            Failed to fetch PRs for repo {repo['name']}")
+                prs = []
                 continue
-            for workflow in workflows_response.json().get('workflows', []):
-                raw_workflow_url = get_raw_workflow_url(repo['name'], workflow['path'], org, default_branch)
-                print(f"    Fetching workflow file from: {raw_workflow_url}")
-                workflow_file_content = get_workflow_file(raw_workflow_url, headers)
-                if workflow_file_content and is_pr_triggered_workflow(workflow_file_content):
-                    print(f"        Workflow {workflow['name']} in {repo['name']} is triggered by pull requests.")
-                    prs_url = f"https://api.github.com/repos/{org}/{repo['name']}/pulls"
-                    print(f"        Fetching PRs in forks of repository: {repo['name']}")
-                    prs_response = requests.get(prs_url, headers=headers)
-                    if prs_response.status_code != 200:
-                        print(f"            Failed to fetch PRs for repo {repo['name']}")
-                        continue
-                    for pr in prs_response.json():
-                        # Check if the head repository of the PR exists before accessing its full name
-                        if pr['head']['repo'] is not None and pr['head']['repo']['full_name'] != f"{org}/{repo['name']}":
-                            print(f"            PR: {pr['html_url']}")
-                        else:
-                            print(f"            Skipping PR with missing head repo: {pr['html_url']}")
-                else:
-                    print(f"        Workflow is not triggered by PR")
-        page += 1
+            prs = prs_response.json()
+            for pr in prs:
+                if pr['head']['repo'] is not None and pr['head']['repo']['full_name'] != full_name:
+                    ci_common.record_result('fork_pr', full_name, pr['html_url'], pr['head']['repo']['full_name'])
+        for pr in prs:
+            # Check if the head repository of the PR exists before accessing its full name
+            if pr['head']['repo'] is not None and pr['head']['repo']['full_name'] != full_name:
+                print(f"            PR: {pr['html_url']}")
+            else:
+                print(f"            Skipping PR with missing head repo: {pr['html_url']}")
+
+def get_fork_pr_urls(org, token, specific_repo=None):
+    shard = ci_common.Shard(ci_common.SHARD, ci_common.SHARD_LEASES)
+    # One GraphQL page covers 100 repositories including their default branches
+    repos = ci_common.get_repo_inventory(org, token, privacy='PUBLIC')
+    if specific_repo:
+        repos = (repo for repo in repos if repo['name'].lower() == specific_repo.lower())
+    for repo in shard.select(repos, key=lambda repo: repo['name']):
+        check_repo(org, repo, token)
+        shard.done(repo['name'])
 
 try:
     get_fork_pr_urls(org, token, specific_repo)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Combine the progress files and download directories written by the workers of a sharded scan."""
+import argparse
+import ci_common
+import os
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the results of workers started with --shard/--leases (CI_SHARD/CI_SHARD_LEASES)')
+    subparsers = parser.add_subparsers(dest='kind', required=True)
+    progress = subparsers.add_parser('progress', help='Merge CircleCI progress files, keeping the highest job and pipeline numbers')
+    progress.add_argument('target', help='Progress file to merge into, e.g. download_progress.sqlite')
+    progress.add_argument('sources', nargs='+', help='Progress files written by the workers')
+    artifacts = subparsers.add_parser('artifacts', help='Merge artifact download directories and their file indexes, storing identical content once')
+    artifacts.add_argument('target', help='Download directory to merge into, e.g. DownloadedGitArtifacts')
+    artifacts.add_argument('sources', nargs='+', help='Download directories written by the workers')
+    args = parser.parse_args()
+
+    if args.kind == 'progress':
+        store = ci_common.ProgressStore(args.target)
+        for source in args.sources:
+            store.merge(source)
+            print(f"Merged progress from {source}")
+        store.close()
+    else:
+        store = ci_common.ArtifactStore(args.target)
+        index = None
+        for source in args.sources:
+            print(f"Merged {store.merge(source)} files from {source}")
+            source_index = os.path.join(source, '.index.sqlite')
+            if os.path.exists(source_index):
+                index = index or ci_common.ArtifactIndex(os.path.join(args.target, '.index.sqlite'))
+                index.merge(source_index)
+        if index:
+            index.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""Local stand-in for the GitHub and CircleCI endpoints used by the scripts in this repository.
+
+GitHub is served under /github (point GITHUB_API_URL there) and CircleCI under
+/circleci (point CIRCLECI_URL there). The organization is generated from the
+command line options, so runs are repeatable without touching live services.
+GET /_stats returns request and byte counters for benchmarking.
+"""
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import re
+import threading
+import time
+import zipfile
+from urllib.parse import parse_qs, urlencode, urlparse
+
+WORKFLOW_FILES = {
+    '.github/workflows/ci.yml': "name: CI\non:\n  push:\n  pull_request:\njobs:\n  test:\n    runs-on: ubuntu-latest\n    steps:\n      - run: make test\n",
+    '.github/workflows/release.yml': "name: Release\non:\n  push:\n    tags: ['v*']\njobs:\n  release:\n    runs-on: ubuntu-latest\n    steps:\n      - run: make release\n",
+}
+ARTIFACT_NAMES = ('build-output', 'test-results', 'coverage')  # Repeated names give identical payloads, as real builds do
+
+
+class MockOrg:
+    """Deterministic organization layout shared by the GitHub and CircleCI endpoints."""
+
+    def __init__(self, args):
+        self.name = args.org
+        self.repos = [f"repo-{i:04d}" for i in range(args.repos)]
+        self.artifacts_per_repo = args.artifacts
+        self.pipelines_per_repo = args.pipelines
+        self.jobs_per_workflow = args.jobs
+        self.artifact_size = args.artifact_kb * 1024
+        self.payloads = {}
+
+    def repo(self, name, base):
+        index = self.repos.index(name)
+        return {
+            'name': name,
+            'full_name': f"{self.name}/{name}",
+            'default_branch': 'main',
+            'private': False,
+            'visibility': 'public',
+            'fork': False,
+            'pushed_at': '2024-01-01T00:00:00Z',
+            'permissions': {'admin': index % 4 == 0, 'push': index % 4 < 2, 'pull': True},
+            'url': f"{base}/repos/{self.name}/{name}",
+        }
+
+    def payload(self, seed):
+        if seed not in self.payloads:
+            block = hashlib.sha256(seed.encode('utf-8')).digest()
+            self.payloads[seed] = (block * (self.artifact_size // len(block) + 1))[:self.artifact_size]
+        return self.payloads[seed]
+
+    def zip_payload(self, seed):
+        """A stored zip of about the artifact size, split over a few members like an uploaded artifact."""
+        key = ('zip', seed)
+        if key not in self.payloads:
+            data = self.payload(seed)
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                for part in range(4):
+                    member = zipfile.ZipInfo(f"{seed}/reports/part-{part}.txt", date_time=(2024, 1, 1, 0, 0, 0))
+                    archive.writestr(member, data[part * len(data) // 4:(part + 1) * len(data) // 4])
+            self.payloads[key] = buffer.getvalue()
+        return self.payloads[key]
+
+    def github_artifacts(self, repo, base):
+        artifacts = []
+        for i in range(self.artifacts_per_repo):
+            artifact_id = self.repos.index(repo) * 100000 + i
+            name = ARTIFACT_NAMES[i % len(ARTIFACT_NAMES)]
+            payload = self.zip_payload(name)
+            artifacts.append({
+                'id': artifact_id,
+                'name': name,
+                'size_in_bytes': len(payload),
+                'digest': f"sha256:{hashlib.sha256(payload).hexdigest()}",
+                'expired': i % 10 == 9,
+                'created_at': f"2024-01-{1 + i % 28:02d}T00:00:00Z",
+                'workflow_run': {'id': 1000 + i // 2},
+                'archive_download_url': f"{base}/repos/{self.name}/{repo}/actions/artifacts/{artifact_id}/zip",
+            })
+        return artifacts[::-1]  # Newest first, like GitHub
+
+    def pipelines(self, repo):
+        return [
+            {'id': f"{repo}-p{n}", 'number': n, 'state': 'created', 'created_at': f"2024-02-{n % 28 + 1:02d}T00:00:00Z", 'trigger': {'type': 'webhook'}}
+            for n in range(self.pipelines_per_repo, 0, -1)
+        ]
+
+    def jobs(self, pipeline_number):
+        return [{'job_number': pipeline_number * 100 + j, 'name': f"job-{j}", 'status': 'success'} for j in range(self.jobs_per_workflow)]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def add(self, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+
+class RateLimit:
+    """Hourly request budget per Authorization header and resource (core or graphql), reported through X-RateLimit-* headers."""
+
+    def __init__(self, limit, enforce):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.budgets = {}  # (Authorization header, resource) -> [remaining, reset]
+        self.enforce = enforce
+
+    def take(self, authorization, resource='core'):
+        with self.lock:
+            budget = self.budgets.setdefault((authorization, resource), [self.limit, int(time.time()) + 3600])
+            if time.time() >= budget[1]:
+                budget[:] = [self.limit, int(time.time()) + 3600]
+            allowed = budget[0] > 0 or not self.enforce
+            budget[0] = max(0, budget[0] - 1)
+            return allowed, {
+                'X-RateLimit-Limit': str(self.limit),
+                'X-RateLimit-Remaining': str(budget[0]),
+                'X-RateLimit-Reset': str(budget[1]),
+                'X-RateLimit-Resource': resource,
+            }
+
+
+def paginate(items, query, default_per_page=30):
+    per_page = int(query.get('per_page', [default_per_page])[0])
+    page = int(query.get('page', ['1'])[0])
+    start = (page - 1) * per_page
+    return items[start:start + per_page], page, start + per_page < len(items)
+
+
+def circleci_page(items, query, page_size=20):
+    start = int(query.get('page-token', ['0'])[0])
+    end = start + page_size
+    return {'items': items[start:end], 'next_page_token': str(end) if end < len(items) else None}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    org = None
+    stats = None
+    rate_limit = None
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def base(self, prefix):
+        return f"http://{self.headers['Host']}{prefix}"
+
+    def send(self, status, body=b'', headers=None, content_type='application/json', counted=True):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        if counted:
+            self.stats.add(0 if self.command == 'HEAD' else len(body))
+
+    def send_json(self, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        headers = dict(headers or {}, ETag=etag)
+        if self.headers.get('If-None-Match') == etag:
+            self.send(304, headers=headers)
+        else:
+            self.send(200, body, headers)
+
+    def send_payload(self, payload, headers):
+        """Send binary content, honouring a single open-ended byte range."""
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= len(payload):
+                self.send(416, headers=dict(headers, **{'Content-Range': f"bytes */{len(payload)}"}))
+                return
+            headers = dict(headers, **{'Content-Range': f"bytes {start}-{len(payload) - 1}/{len(payload)}"})
+            self.send(206, payload[start:], headers, 'application/zip')
+        else:
+            self.send(200, payload, headers, 'application/zip')
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/_stats':
+            with self.stats.lock:
+                counters = {'requests': self.stats.requests, 'bytes_sent': self.stats.bytes_sent}
+            self.send(200, counters, counted=False)
+            return
+        allowed, headers = self.rate_limit.take(self.headers.get('Authorization', ''))
+        if not allowed:
+            self.send(403, {'message': 'API rate limit exceeded'}, headers)
+            return
+        if url.path.startswith('/github/'):
+            self.github_get(url.path[len('/github'):], query, headers)
+        elif url.path.startswith('/raw/'):
+            self.raw_get(url.path[len('/raw'):], headers)
+        elif url.path.startswith('/circleci/'):
+            self.circleci_get(url.path[len('/circleci'):], query, headers)
+        else:
+            self.send(404, {'message': 'Not Found'}, headers)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        allowed, headers = self.rate_limit.take(self.headers.get('Authorization', ''), 'graphql' if self.path.endswith('/graphql') else 'core')
+        if not allowed:
+            self.send(403, {'message': 'API rate limit exceeded'}, headers)
+        elif self.path == '/github/graphql':
+            self.graphql(json.loads(body), headers)
+        elif self.path.startswith('/circleci/u/login'):
+            self.send(200, b'<html>logged in</html>', headers, 'text/html')
+        else:
+            self.send(404, {'message': 'Not Found'}, headers)
+
+    def github_get(self, path, query, headers):
+        org = self.org
+        base = self.base('/github')
+        repo_match = re.match(rf'/repos/{re.escape(org.name)}/([^/]+)(/.*)?$', path)
+        if path == f"/orgs/{org.name}/repos":
+            repos, page, more = paginate([org.repo(name, base) for name in org.repos], query)
+            if more:
+                headers['Link'] = f'<{base}{path}?per_page={len(repos)}&page={page + 1}>; rel="next"'
+            self.send_json(repos, headers)
+        elif repo_match and repo_match.group(1) in org.repos:
+            repo, rest = repo_match.group(1), repo_match.group(2) or ''
+            if rest == '':
+                self.send_json(org.repo(repo, base), headers)
+            elif rest == '/actions/artifacts':
+                artifacts = [a for a in org.github_artifacts(repo, base) if a['name'] in query.get('name', [a['name']])]
+                total_count = len(artifacts)
+                artifacts, page, more = paginate(artifacts, query)
+                if more:
+                    next_query = urlencode(dict(query, per_page=[len(artifacts)], page=[page + 1]), doseq=True)
+                    headers['Link'] = f'<{base}{path}?{next_query}>; rel="next"'
+                self.send_json({'total_count': total_count, 'artifacts': artifacts}, headers)
+            elif re.match(r'/actions/artifacts/\d+/zip$', rest):
+                artifact_id = int(rest.split('/')[3])
+                artifact = next((a for a in org.github_artifacts(repo, base) if a['id'] == artifact_id), None)
+                if artifact:
+                    self.send_payload(org.zip_payload(artifact['name']), headers)
+                else:
+                    self.send(404, {'message': 'Not Found'}, headers)
+            elif rest == '/actions/workflows':
+                workflows = [{'name': path.rsplit('/', 1)[1], 'path': path} for path in WORKFLOW_FILES]
+                self.send_json({'total_count': len(workflows), 'workflows': workflows}, headers)
+            elif rest == '/pulls':
+                self.send_json([
+                    {'html_url': f"https://github.com/{org.name}/{repo}/pull/1", 'head': {'repo': {'full_name': f"contributor/{repo}"}}},
+                    {'html_url': f"https://github.com/{org.name}/{repo}/pull/2", 'head': {'repo': {'full_name': f"{org.name}/{repo}"}}},
+                ], headers)
+            else:
+                self.send(404, {'message': 'Not Found'}, headers)
+        else:
+            self.send(404, {'message': 'Not Found'}, headers)
+
+    def raw_get(self, path, headers):
+        match = re.match(rf'/{re.escape(self.org.name)}/([^/]+)/[^/]+/(.+)$', path)
+        if match and match.group(1) in self.org.repos and match.group(2) in WORKFLOW_FILES:
+            self.send(200, WORKFLOW_FILES[match.group(2)].encode('utf-8'), headers, 'text/plain')
+        else:
+            self.send(404, b'404: Not Found', headers, 'text/plain')
+
+    def graphql(self, request, headers):
+        org = self.org
+        query, variables = request['query'], request.get('variables') or {}
+        if 'organization(' in query:
+            start = int(variables.get('cursor') or 0)
+            names = org.repos[start:start + 100]
+            permissions = ('ADMIN', 'WRITE', 'READ', 'READ')
+            nodes = [{
+                'name': name,
+                'viewerPermission': permissions[org.repos.index(name) % 4],
+                'defaultBranchRef': {'name': 'main'},
+                'visibility': 'PUBLIC',
+                'isFork': False,
+                'pushedAt': '2024-01-01T00:00:00Z',
+            } for name in names]
+            more = start + 100 < len(org.repos)
+            page_info = {'hasNextPage': more, 'endCursor': str(start + 100) if more else None}
+            self.send_json({'data': {'organization': {'repositories': {'pageInfo': page_info, 'nodes': nodes}}}}, headers)
+        elif 'repository(' in query and variables.get('name') in org.repos:
+            entries = [{
+                'name': path.rsplit('/', 1)[1],
+                'path': path,
+                'oid': hashlib.sha1(text.encode('utf-8')).hexdigest(),
+                'object': {'text': text},
+            } for path, text in WORKFLOW_FILES.items()]
+            self.send_json({'data': {'repository': {'object': {'entries': entries}}}}, headers)
+        else:
+            self.send_json({'data': None, 'errors': [{'message': 'Unsupported query'}]}, headers)
+
+    def circleci_get(self, path, query, headers):
+        org = self.org
+        base = self.base('/circleci')
+        project = re.match(rf'/api/v2/project/gh/{re.escape(org.name)}/([^/]+)/(pipeline|\d+/artifacts)$', path)
+        if project and project.group(1) in org.repos:
+            repo = project.group(1)
+            if project.group(2) == 'pipeline':
+                self.send_json(circleci_page(org.pipelines(repo), query), headers)
+            else:
+                job_number = int(project.group(2).split('/')[0])
+                artifacts = [{
+                    'path': f"{ARTIFACT_NAMES[i % len(ARTIFACT_NAMES)]}/output-{i}.txt",
+                    'url': f"{base}/artifacts/{repo}/{job_number}/{i}",
+                } for i in range(org.artifacts_per_repo)]
+                self.send_json(circleci_page(artifacts, query), headers)
+        elif re.match(r'/api/v2/pipeline/[^/]+/workflow$', path):
+            pipeline_id = path.split('/')[4]
+            self.send_json(circleci_page([{'id': f"{pipeline_id}-w", 'name': 'build', 'status': 'success'}], query), headers)
+        elif re.match(r'/api/v2/workflow/[^/]+/job$', path):
+            pipeline_number = int(path.split('/')[4].rsplit('-p', 1)[1].split('-')[0])
+            self.send_json(circleci_page(org.jobs(pipeline_number), query), headers)
+        elif re.match(r'/artifacts/[^/]+/\d+/\d+$', path):
+            index = int(path.rsplit('/', 1)[1])
+            self.send_payload(org.payload(ARTIFACT_NAMES[index % len(ARTIFACT_NAMES)]), headers)
+        elif path.startswith('/api/private/output/raw/github/'):
+            self.send(200, b'export CI=true\nexport NODE_ENV=test\n', headers, 'text/plain')
+        elif path == '/auth/login':
+            self.send(302, headers=dict(headers, Location=f"{base}/u/login?state=mock-state"))
+        elif path.startswith('/u/login'):
+            self.send(200, b'<html>login</html>', headers, 'text/html')
+        else:
+            self.send(404, {'message': 'Not Found'}, headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a generated organization on the GitHub and CircleCI endpoints used by these scripts')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on, 0 picks a free one (default: 8765)')
+    parser.add_argument('--org', default='mock-org', help='Organization name (default: mock-org)')
+    parser.add_argument('--repos', type=int, default=50, help='Repositories in the organization (default: 50)')
+    parser.add_argument('--artifacts', type=int, default=5, help='Artifacts per repository and per CircleCI job (default: 5)')
+    parser.add_argument('--artifact-kb', type=int, default=64, help='Size of each artifact payload in KB (default: 64)')
+    parser.add_argument('--pipelines', type=int, default=5, help='CircleCI pipelines per project (default: 5)')
+    parser.add_argument('--jobs', type=int, default=2, help='CircleCI jobs per workflow (default: 2)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every response (default: 0)')
+    parser.add_argument('--rate-limit', type=int, default=1000000, help='Hourly request budget per token reported in X-RateLimit-* headers (default: 1000000)')
+    parser.add_argument('--enforce-rate-limit', action='store_true', help='Answer 403 once the budget is used up')
+    args = parser.parse_args()
+
+    Handler.org = MockOrg(args)
+    Handler.stats = Stats()
+    Handler.rate_limit = RateLimit(args.rate_limit, args.enforce_rate_limit)
+    Handler.latency = args.latency_ms / 1000
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    server.daemon_threads = True
+    print(f"Listening on http://127.0.0.1:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()